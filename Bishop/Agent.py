@@ -5,12 +5,15 @@ Stores information about agent and comes with supporting methods to sample rando
 """
 
 import random
+import warnings
 import numpy as np
+import scipy.special
+from itertools import product
 
 
 class Agent(object):
 
-    def __init__(self, Map, CostPrior, RewardPrior, CostParams, RewardParams, Capacity=-1, Minimum=0, SoftmaxChoice=True, SoftmaxAction=True, choiceTau=1, actionTau=0.01, CNull=0, RNull=0, Restrict=False):
+    def __init__(self, Map, CostPrior, RewardPrior, CostParams, RewardParams, Capacity=-1, Minimum=0, SoftmaxChoice=True, SoftmaxAction=True, choiceTau=1, actionTau=0.01, CNull=0, RNull=0, Restrict=False, Sampling="Random"):
         """
         Agent class.
 
@@ -34,6 +37,8 @@ class Agent(object):
             RNull (float): Probability that an object has no reward
             Restrict (bool): When set to true the cost samples make the first terrain
                             always less costly than the rest.
+            Sampling (str): How to generate prior draws. "Random" (default), or "Sobol" and "Halton"
+                            for scrambled low-discrepancy (quasi-Monte Carlo) sequences. See SetSampling().
         """
         # Check that priors exist.
         Priors = self.Priors(False)
@@ -75,6 +80,7 @@ class Agent(object):
             self.RewardParams = [RewardParams]
         self.CNull = CNull
         self.RNull = RNull
+        self.SetSampling(Sampling)
         self.ResampleCosts()  # Generate random cost of map
         self.ResampleRewards()  # Generate random rewards for objects
 
@@ -88,8 +94,15 @@ class Agent(object):
         Returns:
             None
         """
-        self.ResampleCosts()
-        self.ResampleRewards()
+        if self.Sampling == "Random":
+            self.ResampleCosts()
+            self.ResampleRewards()
+        else:
+            # Take the next point of the low-discrepancy sequence and split it
+            # into the cost and the reward dimensions.
+            Point = self.NextQMCPoint()
+            self.ResampleCosts(Point[:self.CostDimensions])
+            self.ResampleRewards(Point[self.CostDimensions:])
         if self.Restrict:
             temp = self.costs[0]
             new = self.costs.argmin()
@@ -97,31 +110,128 @@ class Agent(object):
             self.costs[new] = temp
             self.costs[0] = minval
 
-    def ResampleCosts(self):
+    def ResampleCosts(self, Uniforms=None):
         """
         Reset agent's costs.
+
+        Args:
+            Uniforms (list): (optional) One number in (0,1) per terrain. When provided the costs are
+                             obtained by pushing these numbers through the prior's inverse CDF
+                             (used for quasi-Monte Carlo sampling) instead of drawing them at random.
         """
-        # Resample the agent's competence
-        self.costs = self.Sample(
-            self.CostDimensions, self.CostParams, Kind=self.CostPrior)
-        self.costs = [
-            0 if random.random() <= self.CNull else i for i in self.costs]
+        if Uniforms is None:
+            # Resample the agent's competence
+            self.costs = self.Sample(
+                self.CostDimensions, self.CostParams, Kind=self.CostPrior)
+            self.costs = [
+                0 if random.random() <= self.CNull else i for i in self.costs]
+        else:
+            [Nulls, Uniforms] = self.SplitNullMass(Uniforms, self.CNull)
+            self.costs = self.Sample(
+                self.CostDimensions, self.CostParams, self.CostPrior, Uniforms)
+            self.costs = [0 if Nulls[i] else self.costs[i]
+                          for i in range(self.CostDimensions)]
 
-    def ResampleRewards(self):
+    def ResampleRewards(self, Uniforms=None):
         """
         Reset agent's rewards.
 
+        Args:
+            Uniforms (list): (optional) One number in (0,1) per object type. See ResampleCosts().
+
         Returns:
             None
         """
-        # Resample the agent's preferences
-        self.rewards = self.Sample(
-            self.RewardDimensions, self.RewardParams, Kind=self.RewardPrior)
-        if self.rewards is not None:
-            self.rewards = [
-            0 if random.random() <= self.RNull else i for i in self.rewards]
+        if Uniforms is None:
+            # Resample the agent's preferences
+            self.rewards = self.Sample(
+                self.RewardDimensions, self.RewardParams, Kind=self.RewardPrior)
+            if self.rewards is not None:
+                self.rewards = [
+                0 if random.random() <= self.RNull else i for i in self.rewards]
+        else:
+            [Nulls, Uniforms] = self.SplitNullMass(Uniforms, self.RNull)
+            self.rewards = self.Sample(
+                self.RewardDimensions, self.RewardParams, self.RewardPrior, Uniforms)
+            if self.rewards is not None:
+                self.rewards = [0 if Nulls[i] else self.rewards[i]
+                                for i in range(self.RewardDimensions)]
+
+    def SplitNullMass(self, Uniforms, PNull):
+        """
+        Use a uniform number to decide if a dimension falls on the point mass at zero (CNull/RNull)
+        and rescale the remaining numbers so they are uniform again on (0,1).
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Uniforms (list): Numbers in (0,1)
+            PNull (float): Probability of the point mass at zero.
+
+        Returns:
+            [Nulls, Uniforms]: List of booleans marking null dimensions and the rescaled numbers.
+        """
+        Uniforms = np.asarray(Uniforms, dtype=float)
+        Nulls = Uniforms <= PNull
+        if PNull <= 0 or PNull >= 1:
+            return [Nulls, Uniforms]
+        # Both branches are rescaled so that every coordinate is still a valid
+        # input for the inverse CDFs (Simplex uses all of them).
+        return [Nulls, np.where(Nulls, Uniforms / PNull, (Uniforms - PNull) / (1.0 - PNull))]
 
-    def Sample(self, dimensions, SamplingParam, Kind):
+    def SetSampling(self, Method="Random", Seed=None):
+        """
+        Set how the agent generates prior draws and restart the sequence.
+
+        Sobol and Halton draw scrambled low-discrepancy sequences and push each point
+        through the inverse CDF of the cost and reward priors (the CNull and RNull point masses
+        are handled as a mixture on each coordinate). The Sobol sequence is best balanced when the
+        number of samples is a power of two.
+
+        Args:
+            Method (str): "Random", "Sobol", or "Halton".
+            Seed (int): Seed for the scrambling. When None, the seed is drawn from numpy's random state
+                        so that np.random.seed() still makes runs reproducible.
+        """
+        if Method not in ["Random", "Sobol", "Halton"]:
+            print("WARNING: Sampling method not found! Setting to random. AGENT-002")
+            Method = "Random"
+        self.Sampling = Method
+        self.SamplingSeed = Seed
+        self.QMCEngine = None
+
+    def NextQMCPoint(self):
+        """
+        Get the next point from the agent's low-discrepancy sequence.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Returns:
+            Point (array): Numbers in (0,1), one for each cost dimension followed by one for each reward dimension.
+        """
+        if self.QMCEngine is None:
+            # scipy.stats is slow to import, so it's only loaded when quasi-random sampling is used
+            from scipy.stats import qmc
+            Seed = self.SamplingSeed
+            if Seed is None:
+                Seed = np.random.randint(2 ** 31)
+            Dimensions = self.CostDimensions + self.RewardDimensions
+            if self.Sampling == "Sobol":
+                self.QMCEngine = qmc.Sobol(Dimensions, scramble=True, seed=Seed)
+            else:
+                self.QMCEngine = qmc.Halton(Dimensions, scramble=True, seed=Seed)
+        with warnings.catch_warnings():
+            # Sobol warns about balance whenever the running total isn't a power of 2.
+            warnings.simplefilter("ignore")
+            Point = self.QMCEngine.random(1)[0]
+        # Keep points away from the edges so inverse CDFs stay finite.
+        return np.clip(Point, 1e-10, 1 - 1e-10)
+
+    def Sample(self, dimensions, SamplingParam, Kind, Uniforms=None):
         """
         Generate a sample from some distribution
 
@@ -129,12 +239,16 @@ class Agent(object):
             dimensions (int): Number of dimensions
             SamplingParam (list): Parameter to use on distribution
             Kind (str): Name of distribution
+            Uniforms (list): (optional) Numbers in (0,1), one per dimension. When provided, the sample is
+                             the distribution's inverse CDF evaluated at these points.
 
         Returns:
             None
         """
         if dimensions == 0:
             return None
+        if Uniforms is not None:
+            return self.InverseSample(dimensions, SamplingParam, Kind, Uniforms)
         if (Kind == "Simplex"):
             # Output: Simplex sample of length 'dimensions' (Adds to 1)
             sample = -np.log(np.random.rand(dimensions))
@@ -174,6 +288,166 @@ class Agent(object):
             samples = [0 if i < 0 else i for i in samples]
             return samples
 
+    def InverseSample(self, dimensions, SamplingParam, Kind, Uniforms):
+        """
+        Transform uniform numbers into a sample through the inverse CDF of a prior.
+        Mirrors Sample() for every supported prior.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            dimensions (int): Number of dimensions
+            SamplingParam (list): Parameter to use on distribution
+            Kind (str): Name of distribution
+            Uniforms (list): Numbers in (0,1), one per dimension.
+        """
+        u = np.asarray(Uniforms, dtype=float)
+        if (Kind == "Simplex"):
+            sample = -np.log(u)
+            return sample / sum(sample)
+        if (Kind == "IntegerUniform"):
+            return np.round(u * SamplingParam[0])
+        if (Kind == "ScaledUniform"):
+            return u * SamplingParam[0]
+        if (Kind == "Gaussian"):
+            return SamplingParam[0] + SamplingParam[1] * scipy.special.ndtri(u)
+        if (Kind == "Exponential"):
+            return list(-SamplingParam[0] * np.log1p(-u))
+        if (Kind == "Constant"):
+            return [0.5 * SamplingParam[0]] * dimensions
+        if (Kind == "Beta"):
+            return list(scipy.special.betaincinv(SamplingParam[0], SamplingParam[1], u))
+        if (Kind == "Empirical"):
+            indices = np.minimum(
+                (u * len(SamplingParam)).astype(int), len(SamplingParam) - 1)
+            return [SamplingParam[i] for i in indices]
+        if (Kind == "PartialUniform"):
+            samples = u * SamplingParam[0]
+            for i in range(1, len(SamplingParam)):
+                if SamplingParam[i] != -1:
+                    samples[i - 1] = SamplingParam[i]
+            return samples
+        if (Kind == "PartialGaussian"):
+            samples = SamplingParam[0] + SamplingParam[1] * scipy.special.ndtri(u)
+            for i in range(2, len(SamplingParam)):
+                if SamplingParam[i] != -1:
+                    samples[i - 2] = SamplingParam[i]
+            samples = [0 if i < 0 else i for i in samples]
+            return samples
+
+    def PriorSupport(self, dimensions, SamplingParam, Kind, PNull=0):
+        """
+        Get the finite support of a prior, one list of values and masses per dimension.
+
+        Only IntegerUniform, Empirical, and Constant priors have a finite support.
+        The point mass at zero (CNull/RNull) is folded into each dimension.
+
+        Args:
+            dimensions (int): Number of dimensions
+            SamplingParam (list): Parameter to use on distribution
+            Kind (str): Name of distribution
+            PNull (float): Probability that a dimension is set to zero.
+
+        Returns:
+            Support (list): Support[i] is a [values, masses] pair for dimension i, or None if the support isn't finite.
+        """
+        if (Kind == "IntegerUniform"):
+            # np.round(u * p) hits k when u*p lies in [k-0.5, k+0.5).
+            scale = SamplingParam[0]
+            if scale == 0:
+                values = [0.0]
+                masses = [1.0]
+            else:
+                values = [float(k) for k in range(int(np.round(scale)) + 1)]
+                masses = [min(max((k + 0.5) / scale, 0), 1) - min(max((k - 0.5) / scale, 0), 1)
+                          for k in values]
+        elif (Kind == "Empirical"):
+            values = sorted(set(SamplingParam))
+            masses = [SamplingParam.count(v) * 1.0 / len(SamplingParam) for v in values]
+        elif (Kind == "Constant"):
+            values = [0.5 * SamplingParam[0]]
+            masses = [1.0]
+        else:
+            return None
+        if PNull > 0:
+            masses = [m * (1 - PNull) for m in masses]
+            if 0 in values:
+                masses[values.index(0)] += PNull
+            else:
+                values.append(0)
+                masses.append(PNull)
+        # Drop values the prior can't produce.
+        Support = [[v for v, m in zip(values, masses) if m > 0],
+                   [m for m in masses if m > 0]]
+        return [Support] * dimensions
+
+    def FiniteSupport(self):
+        """
+        Check if both the cost and the reward prior have a finite support (see PriorSupport()).
+        """
+        if self.PriorSupport(self.CostDimensions, self.CostParams, self.CostPrior, self.CNull) is None:
+            return False
+        if self.RewardDimensions > 0 and self.PriorSupport(self.RewardDimensions, self.RewardParams, self.RewardPrior, self.RNull) is None:
+            return False
+        return True
+
+    def EnumeratePriors(self):
+        """
+        Enumerate every cost and every reward vector the priors can produce, along with their prior probabilities.
+        Duplicate vectors (e.g., produced by the Restrict swap) are merged.
+
+        Returns:
+            [Costs, CostMasses, Rewards, RewardMasses] or None if the priors don't have finite supports.
+            Costs and Rewards are lists of vectors, and the joint probability of Costs[i] and Rewards[j]
+            is CostMasses[i] * RewardMasses[j].
+        """
+        if not self.FiniteSupport():
+            print("ERROR: Priors do not have a finite support. AGENT-003")
+            return None
+        Costs = self.EnumerateSupport(self.PriorSupport(
+            self.CostDimensions, self.CostParams, self.CostPrior, self.CNull), self.Restrict)
+        if self.RewardDimensions == 0:
+            Rewards = [[None], [1.0]]
+        else:
+            Rewards = self.EnumerateSupport(self.PriorSupport(
+                self.RewardDimensions, self.RewardParams, self.RewardPrior, self.RNull))
+        return Costs + Rewards
+
+    def EnumerateSupport(self, Support, Restrict=False):
+        """
+        Combine the support of each dimension into a list of vectors and their probabilities.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Support (list): Output of PriorSupport()
+            Restrict (bool): Apply the Restrict swap (see ResampleAgent()).
+
+        Returns:
+            [Vectors, Masses]
+        """
+        Vectors = []
+        Masses = []
+        Index = {}
+        for combination in product(*[list(zip(values, masses)) for [values, masses] in Support]):
+            vector = [value for (value, mass) in combination]
+            mass = np.prod([mass for (value, mass) in combination])
+            if Restrict:
+                new = int(np.argmin(vector))
+                [vector[0], vector[new]] = [vector[new], vector[0]]
+            key = tuple(vector)
+            if key in Index:
+                Masses[Index[key]] += mass
+            else:
+                Index[key] = len(Vectors)
+                Vectors.append(vector)
+                Masses.append(mass)
+        return [Vectors, Masses]
+
     def Priors(self, human=True):
         """
         Print list of supported priors.
@@ -7,14 +7,20 @@ Supporting functions for Bishop
 import configparser
 import os
 import sys
+import json
 import pickle
-import pkg_resources
+import numpy as np
+import scipy.special
 import copy
 from . import Observer
 from . import PosteriorContainer
+from . import PosteriorReducer
 from . import Map
 from . import Agent
 
+# First bytes of a PosteriorContainer saved in binary format
+BinarySamplesMagic = b"BISHOPPC"
+
 
 def ProbabilityOfChange(ContA, ContB, TestVariable, Tolerance=None):
     """
@@ -24,69 +30,96 @@ def ProbabilityOfChange(ContA, ContB, TestVariable, Tolerance=None):
     Args:
         ContainerA (PosteriorContainer): PosteriorContainer object
         ContainerB (PosteriorContainer): PosteriorContainer object
-        TestVariable (string): Random variable to test. Must exist in both containers
+        TestVariable (string or list): Random variable to test. Must exist in both containers.
+            When it's a list of variables, all of them are tested in one pass.
         Tolerance (float): When different that None, Tolerance determines how many floating
         points to leave in samples. Thus, if tolerance=1, the function returns the probability that
         TestVariable is larger than .1
 
-    Returns [ProbabilitySame, ProbabilityDifferent]
+    Returns [ProbabilitySame, ProbabilityDifferent] (a list of them when TestVariable is a list)
     """
     # Condtitioning is already accounted. So now just add the different
-    # probabilities:
-    P_Same = 0
-    P_Diff = 0
+    # probabilities of aligned samples in log space.
+    if ContA.Samples != ContB.Samples:
+        print("ERROR: Containers have a different number of samples. AUXILIARYFUNCTIONS-004")
+        return None
+    Variables = TestVariable if isinstance(TestVariable, list) else [TestVariable]
+    for Variable in Variables:
+        if Variable not in ContA.Columns or Variable not in ContB.Columns:
+            print("ERROR: " + str(Variable) + " isn't in both containers. AUXILIARYFUNCTIONS-005")
+            return None
+    # Only the tested columns are read (and rounded), so containers are never copied.
+    SamplesA = np.asarray(ContA.Data[:, [ContA.Columns[Variable] for Variable in Variables]])
+    SamplesB = np.asarray(ContB.Data[:, [ContB.Columns[Variable] for Variable in Variables]])
     if Tolerance is not None:
-        # If tolerance is set make a deep copy of containers and round them
-        ContainerA = copy.deepcopy(ContA)
-        ContainerB = copy.deepcopy(ContB)
-        ContainerA.CostSamples = np.round(ContainerA.CostSamples, Tolerance)
-        ContainerB.CostSamples = np.round(ContainerB.CostSamples, Tolerance)
-        ContainerA.RewardSamples = np.round(
-            ContainerA.RewardSamples, Tolerance)
-        ContainerB.RewardSamples = np.round(
-            ContainerB.RewardSamples, Tolerance)
-    else:
-        # Otherwise you can just use the original objects
-        ContainerA = ContA
-        ContainerB = ContB
-    # Locate test variable and save its index
-    if TestVariable in ContainerA.ObjectNames:
-        IndexA = ContainerA.ObjectNames.index(TestVariable)
-        IndexB = ContainerB.ObjectNames.index(TestVariable)
-        TestLocation = "Objects"
-    else:
-        IndexA = ContainerA.CostNames.index(TestVariable)
-        IndexB = ContainerB.CostNames.index(TestVariable)
-        TestLocation = "Terrains"
-    for i in range(ContainerA.Samples):
-        Prob = np.exp(ContainerA.LogLikelihoods[i]) * \
-            np.exp(ContainerB.LogLikelihoods[i])
-        if Prob > 0:
-            if TestLocation == "Objects":
-                if ContainerA.RewardSamples[i, IndexA] == ContainerB.RewardSamples[i, IndexB]:
-                    #sys.stdout.write("Sample " + str(i) + " matches\n")
-                    P_Same += Prob
-                else:
-                    #sys.stdout.write("Sample " + str(i) + " doesn't match\n")
-                    P_Diff += Prob
-            else:
-                if ContainerA.CostSamples[i, IndexA] == ContainerB.CostSamples[i, IndexB]:
-                    #sys.stdout.write("Sample " + str(i) + " matches\n")
-                    P_Same += Prob
-                else:
-                    #sys.stdout.write("Sample " + str(i) + " doesn't match\n")
-                    P_Diff += Prob
-    return [P_Same, P_Diff]
+        SamplesA = np.round(SamplesA, Tolerance)
+        SamplesB = np.round(SamplesB, Tolerance)
+    Same = SamplesA == SamplesB
+    LogProbabilities = (np.asarray(ContA.LogLikelihoods) + np.asarray(ContB.LogLikelihoods))[:, np.newaxis]
+    with np.errstate(divide="ignore"):
+        P_Same = np.exp(scipy.special.logsumexp(np.where(Same, LogProbabilities, -np.inf), axis=0))
+        P_Diff = np.exp(scipy.special.logsumexp(np.where(Same, -np.inf, LogProbabilities), axis=0))
+    Results = [[float(P_Same[i]), float(P_Diff[i])] for i in range(len(Variables))]
+    if isinstance(TestVariable, list):
+        return Results
+    return Results[0]
+
+
+def MergeContainers(Containers, Normalize=True):
+    """
+    Merge PosteriorContainers with samples of the same inference (e.g., shards of an inference split across machines).
+
+    Samples are concatenated in the order given and their log-likelihoods are renormalized together,
+    so merging the shards of a sample range gives the container a single run over the full range would have.
+    Each container's LogNormalizer is used to undo its own normalization, so shards can be saved
+    normalized or not.
 
+    Args:
+        Containers (list): List of PosteriorContainer objects (or names of files saved with SaveSamples)
+        Normalize (bool): Normalize the merged log-likelihoods?
 
-def SaveSamples(Container, Name):
+    Returns:
+        PosteriorContainer object
+    """
+    Containers = [LoadSamples(Container) if isinstance(Container, str) else Container for Container in Containers]
+    if len(Containers) == 0 or any(Container is None for Container in Containers):
+        print("ERROR: Nothing to merge. AUXILIARYFUNCTIONS-002")
+        return None
+    First = Containers[0]
+    for Container in Containers[1:]:
+        if (Container.CostDimensions != First.CostDimensions or Container.RewardDimensions != First.RewardDimensions or
+                Container.CostNames != First.CostNames or Container.ObjectNames != First.ObjectNames or
+                list(Container.Actions) != list(First.Actions)):
+            print("ERROR: Containers have different dimensions or observed actions and can't be merged. AUXILIARYFUNCTIONS-003")
+            return None
+    Merged = copy.copy(First)
+    Merged.Data = np.asfortranarray(np.concatenate([Container.Data for Container in Containers]))
+    LogLikelihoods = np.concatenate([Container.UnnormalizedLogLikelihoods() for Container in Containers])
+    Merged.LogNormalizer = float(scipy.special.logsumexp(LogLikelihoods))
+    Merged.Normalized = Normalize
+    if Normalize:
+        if np.exp(Merged.LogNormalizer) == 0:
+            sys.stdout.write("WARNING: All likelihoods are 0.\n")
+        LogLikelihoods = LogLikelihoods - Merged.LogNormalizer
+    Merged.LogLikelihoods = LogLikelihoods
+    Merged.Samples = Merged.Data.shape[0]
+    Merged.RequestedSamples = sum([Container.RequestedSamples for Container in Containers])
+    Merged.MarginalCache = {}
+    return Merged
+
+
+def SaveSamples(Container, Name, Binary=False):
     """
     Save object as a pickle file.
 
     Args:
         Container (PosteriorContainer): PosteriorContainer object
-        Name (string): Filename. Function adds ".p" extension if it's not provided
+        Name (string): Filename. Function adds ".p" extension if it's not provided (".bpc" in binary format)
+        Binary (bool): Save the samples in binary format instead (see SaveBinarySamples)
     """
+    if Binary:
+        SaveBinarySamples(Container, Name)
+        return None
     try:
         if Name[-2:] != ".p":
             Name = Name + ".p"
@@ -95,32 +128,156 @@ def SaveSamples(Container, Name):
         print(error)
 
 
-def LoadSamples(FileName):
+def SaveBinarySamples(Container, Name):
+    """
+    Save a PosteriorContainer in binary format.
+
+    The file starts with BinarySamplesMagic and the length of a JSON header holding every attribute
+    except the samples (names, map file, taus, method, ...). The sample array (column by column)
+    and the log-likelihoods follow as raw little-endian arrays aligned to 64 bytes, so LoadSamples
+    can memory-map them instead of reading them.
+
+    Args:
+        Container (PosteriorContainer): PosteriorContainer object. A PosteriorReducer is saved as a
+                                        PosteriorContainer with its retained samples (see PosteriorReducer.ToContainer()).
+        Name (string): Filename. Function adds ".bpc" extension if it's not provided
+    """
+    if isinstance(Container, PosteriorReducer.PosteriorReducer):
+        Container = Container.ToContainer()
+    try:
+        if Name[-4:] != ".bpc":
+            Name = Name + ".bpc"
+        Data = np.asfortranarray(Container.Data, dtype=Container.Data.dtype.newbyteorder("<"))
+        Header = {}
+        for (Attribute, Value) in vars(Container).items():
+            if Attribute not in ["Data", "LogLikelihoods", "MarginalCache"]:
+                Header[Attribute] = Value
+        Header["DataType"] = Data.dtype.str
+        Header["Shape"] = list(Data.shape)
+        Header = json.dumps(Header, default=JSONValue).encode("utf-8")
+        [DataOffset, LogLikelihoodOffset] = BinarySamplesOffsets(len(Header), Data.nbytes)
+        with open(Name, "wb") as File:
+            File.write(BinarySamplesMagic)
+            File.write(np.array([len(Header)], dtype="<u8").tobytes())
+            File.write(Header)
+            File.write(b"\0" * (DataOffset - File.tell()))
+            # The transpose of a column-major array is row-major, so tofile writes it column by column
+            Data.T.tofile(File)
+            File.write(b"\0" * (LogLikelihoodOffset - File.tell()))
+            np.asarray(Container.LogLikelihoods, dtype="<f8").tofile(File)
+    except Exception as error:
+        print(error)
+
+
+def LoadSamples(FileName, MemoryMap=True):
     """
-    Load samples from a pickle file
+    Load samples from a pickle file or a file saved in binary format (detected automatically)
 
     Args:
         FileName (str): filename
+        MemoryMap (bool): Memory-map the samples of a binary file instead of reading them.
+                          Mapped samples are read from disk as they are used and are copy-on-write
+                          (changes are never written back to the file).
 
     returns:
         Samples
     """
     try:
+        with open(FileName, "rb") as File:
+            Binary = File.read(len(BinarySamplesMagic)) == BinarySamplesMagic
+        if Binary:
+            return LoadBinarySamples(FileName, MemoryMap)
         Samples = pickle.load(open(FileName, "rb"))
         return Samples
     except Exception as error:
         print(error)
 
 
+def LoadBinarySamples(FileName, MemoryMap=True):
+    """
+    Load a PosteriorContainer saved with SaveBinarySamples.
+
+    .. Warning::
+
+       This function is for internal use only. Use LoadSamples instead.
+
+    Args:
+        FileName (str): filename
+        MemoryMap (bool): Memory-map the samples instead of reading them.
+
+    returns:
+        Samples
+    """
+    with open(FileName, "rb") as File:
+        if File.read(len(BinarySamplesMagic)) != BinarySamplesMagic:
+            print("ERROR: " + str(FileName) + " is not a binary samples file. AUXILIARYFUNCTIONS-001")
+            return None
+        HeaderLength = int(np.frombuffer(File.read(8), dtype="<u8")[0])
+        State = json.loads(File.read(HeaderLength).decode("utf-8"))
+    DataType = np.dtype(State.pop("DataType"))
+    Shape = tuple(State.pop("Shape"))
+    [DataOffset, LogLikelihoodOffset] = BinarySamplesOffsets(
+        HeaderLength, DataType.itemsize * Shape[0] * Shape[1])
+    if MemoryMap and Shape[0] > 0:
+        State["Data"] = np.memmap(FileName, dtype=DataType, mode="c",
+                                  offset=DataOffset, shape=Shape, order="F")
+        State["LogLikelihoods"] = np.memmap(FileName, dtype="<f8", mode="c",
+                                            offset=LogLikelihoodOffset, shape=(Shape[0],))
+    else:
+        with open(FileName, "rb") as File:
+            File.seek(DataOffset)
+            State["Data"] = np.fromfile(File, dtype=DataType, count=Shape[0] * Shape[1]).reshape(Shape, order="F")
+            File.seek(LogLikelihoodOffset)
+            State["LogLikelihoods"] = np.fromfile(File, dtype="<f8", count=Shape[0])
+    Container = PosteriorContainer.PosteriorContainer.__new__(PosteriorContainer.PosteriorContainer)
+    Container.__setstate__(State)
+    return Container
+
+
+def BinarySamplesOffsets(HeaderLength, DataSize):
+    """
+    Get the position of the samples and of the log-likelihoods in a binary samples file.
+
+    .. Warning::
+
+       This function is for internal use only.
+
+    Args:
+        HeaderLength (int): Length of the JSON header in bytes
+        DataSize (int): Size of the sample array in bytes
+
+    Returns:
+        [DataOffset, LogLikelihoodOffset]
+    """
+    DataOffset = int(np.ceil((len(BinarySamplesMagic) + 8 + HeaderLength) / 64.0)) * 64
+    LogLikelihoodOffset = int(np.ceil((DataOffset + DataSize) / 64.0)) * 64
+    return [DataOffset, LogLikelihoodOffset]
+
+
+def JSONValue(Value):
+    """
+    Convert numpy values so json can store them.
+
+    .. Warning::
+
+       This function is for internal use only.
+    """
+    if isinstance(Value, np.ndarray):
+        return Value.tolist()
+    if isinstance(Value, np.generic):
+        return Value.item()
+    raise TypeError(str(type(Value)) + " can't be saved in a binary samples file.")
+
+
 def AnalyzeSamples(FileName):
     """
-    Print sample summary from a pickle file
+    Print sample summary from a pickle or binary file. Binary files are memory-mapped.
 
     Args:
         FileName (str): filename
     """
     try:
-        Samples = pickle.load(open(FileName, "rb"))
+        Samples = LoadSamples(FileName)
         Samples.LongSummary()
     except Exception as error:
         print(error)
@@ -378,6 +535,11 @@ def LoadObserver(MapConfig, Silent=False):
     else:
         print("Allowing diagonal travel")
         DiagonalTravel = True
+    if Config.has_option("MapParameters", "ImplicitTransitions"):
+        ImplicitTransitions = Config.getboolean(
+            "MapParameters", "ImplicitTransitions")
+    else:
+        ImplicitTransitions = False
     if Config.has_option("MapParameters", "StartingPoint"):
         StartingPoint = Config.getint(
             "MapParameters", "StartingPoint")
@@ -480,7 +642,7 @@ def LoadObserver(MapConfig, Silent=False):
     # Create objects!
     try:
         MyMap = Map()
-        MyMap.BuildGridWorld(mapwidth, mapheight, DiagonalTravel)
+        MyMap.BuildGridWorld(mapwidth, mapheight, DiagonalTravel, ImplicitTransitions)
         if HasObjects:
             MyMap.InsertObjects(ObjectLocations, ObjectTypes,
                                 Organic, ObjectNames, SurvivalProb)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""
+LikelihoodSurrogate is a nearest-neighbor emulator of the planner's log-likelihood.
+Observer.InferAgent uses it to skip planning for samples that land in well-explored regions of the cost-reward space.
+"""
+
+import numpy as np
+import random
+import sys
+
+
+class LikelihoodSurrogate(object):
+
+    def __init__(self, Neighbors=5, Tolerance=0.1, Radius=0.05, MinimumSamples=50, AuditRate=0.05, Seed=None):
+        """
+        Create a k-nearest-neighbor surrogate over (costs, rewards) -> log-likelihood.
+
+        A sample is answered by the surrogate only when its nearest neighbors are all close and agree.
+        Otherwise the planner computes the log-likelihood and the result is added to the surrogate.
+
+        Args:
+            Neighbors (int): Number of nearest neighbors to consult.
+            Tolerance (float): Largest spread (max - min) of the neighbors' log-likelihoods for a confident prediction.
+            Radius (float): Largest distance to the farthest neighbor for a confident prediction.
+                            Distances are measured after scaling each dimension by the range of samples seen so far.
+            MinimumSamples (int): Number of planner calls before the surrogate starts answering.
+            AuditRate (float): Probability of checking a confident prediction against the planner.
+                               Audits estimate the surrogate's error.
+            Seed (int): Seed for the audit draws (kept separate from the agent's random state).
+        """
+        self.Neighbors = Neighbors
+        self.Tolerance = Tolerance
+        self.Radius = Radius
+        self.MinimumSamples = MinimumSamples
+        self.AuditRate = AuditRate
+        self.RNG = random.Random(Seed)
+        self.Reset()
+
+    def Reset(self, ActionSequence=None):
+        """
+        Forget all stored samples and statistics.
+
+        Args:
+            ActionSequence (list): Action sequence the new samples will belong to.
+        """
+        self.ActionSequence = ActionSequence
+        self.Points = None
+        self.Values = None
+        self.Stored = 0
+        self.PlannerCalls = 0
+        self.SurrogateCalls = 0
+        self.Audits = 0
+        self.AuditErrors = []
+        self.AuditMismatches = 0
+
+    def Predict(self, costs, rewards):
+        """
+        Predict the log-likelihood of a sample.
+
+        Args:
+            costs (list): Cost sample
+            rewards (list): Reward sample
+
+        Returns:
+            LogLikelihood (float) or None when the surrogate isn't confident.
+        """
+        if self.Stored < max(self.MinimumSamples, self.Neighbors):
+            return None
+        Points = self.Points[:self.Stored]
+        Values = self.Values[:self.Stored]
+        Scale = Points.max(axis=0) - Points.min(axis=0)
+        Scale[Scale == 0] = 1
+        Distances = np.sqrt(
+            (((Points - self.Vectorize(costs, rewards)) / Scale) ** 2).sum(axis=1))
+        Nearest = np.argpartition(Distances, self.Neighbors - 1)[:self.Neighbors]
+        if Distances[Nearest].max() > self.Radius:
+            return None
+        NeighborValues = Values[Nearest]
+        if NeighborValues.max() - NeighborValues.min() > self.Tolerance:
+            return None
+        if NeighborValues.max() == (-sys.maxsize - 1):
+            # All neighbors are impossible under the observed actions.
+            return (-sys.maxsize - 1)
+        Weights = 1.0 / (Distances[Nearest] + 1e-12)
+        return float((Weights * NeighborValues).sum() / Weights.sum())
+
+    def Audit(self):
+        """
+        Decide if a confident prediction should be checked against the planner.
+        """
+        return self.RNG.random() < self.AuditRate
+
+    def Add(self, costs, rewards, LogLikelihood, Prediction=None):
+        """
+        Store the planner's log-likelihood for a sample.
+
+        Args:
+            costs (list): Cost sample
+            rewards (list): Reward sample
+            LogLikelihood (float): Log-likelihood computed by the planner.
+            Prediction (float): (optional) Surrogate's prediction for this sample, when the call was an audit.
+        """
+        self.PlannerCalls += 1
+        if Prediction is not None:
+            self.Audits += 1
+            Impossible = (-sys.maxsize - 1)
+            if (Prediction == Impossible) != (LogLikelihood == Impossible):
+                self.AuditMismatches += 1
+            elif LogLikelihood != Impossible:
+                self.AuditErrors.append(abs(Prediction - LogLikelihood))
+            else:
+                self.AuditErrors.append(0.0)
+        Vector = self.Vectorize(costs, rewards)
+        if self.Points is None:
+            self.Points = np.zeros((1024, len(Vector)))
+            self.Values = np.zeros(1024)
+        elif self.Stored == self.Points.shape[0]:
+            self.Points = np.concatenate((self.Points, np.zeros(self.Points.shape)))
+            self.Values = np.concatenate((self.Values, np.zeros(self.Values.shape)))
+        self.Points[self.Stored] = Vector
+        self.Values[self.Stored] = LogLikelihood
+        self.Stored += 1
+
+    def Vectorize(self, costs, rewards):
+        """
+        Join a cost and a reward sample into a single vector.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        if rewards is None:
+            return np.asarray(costs, dtype=float).ravel()
+        return np.concatenate((np.asarray(costs, dtype=float).ravel(), np.asarray(rewards, dtype=float).ravel()))
+
+    def Report(self, human=True):
+        """
+        Report the planner calls saved and the estimated error.
+
+        Args:
+            human (bool): When true the function prints the report, otherwise it returns it as a dictionary.
+        """
+        Report = {"PlannerCalls": self.PlannerCalls,
+                  "SurrogateCalls": self.SurrogateCalls,
+                  "CallsSaved": self.SurrogateCalls * 100.0 / max(self.PlannerCalls + self.SurrogateCalls, 1),
+                  "Audits": self.Audits,
+                  "AuditMismatches": self.AuditMismatches,
+                  "MeanAbsoluteError": np.mean(self.AuditErrors) if self.AuditErrors != [] else None,
+                  "MaxAbsoluteError": np.max(self.AuditErrors) if self.AuditErrors != [] else None}
+        if not human:
+            return Report
+        sys.stdout.write("Planner calls: " + str(Report["PlannerCalls"]) + "\n")
+        sys.stdout.write("Surrogate calls: " + str(Report["SurrogateCalls"]) +
+                         " (" + str(round(Report["CallsSaved"], 2)) + "% of samples)\n")
+        sys.stdout.write("Audited predictions: " + str(Report["Audits"]) + "\n")
+        if Report["MeanAbsoluteError"] is not None:
+            sys.stdout.write("Estimated log-likelihood error: " + str(Report["MeanAbsoluteError"]) +
+                             " (max " + str(Report["MaxAbsoluteError"]) + ")\n")
+        sys.stdout.write("Audits where surrogate and planner disagree on a zero likelihood: " +
+                         str(Report["AuditMismatches"]) + "\n")
+
+    def Display(self, Full=False):
+        """
+        Print object attributes.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Full (bool): When set to False, function only prints attribute names. Otherwise, it also prints its values.
+
+        Returns:
+            standard output summary
+        """
+        if Full:
+            for (property, value) in vars(self).items():
+                print((property, ': ', value))
+        else:
+            for (property, value) in vars(self).items():
+                print(property)
@@ -5,16 +5,28 @@ Markov Decision Process solver.
 """
 
 import numpy as np
-import math
 import random
+import heapq
+import scipy.special
+import scipy.sparse
+import scipy.sparse.csgraph
 
 
 class MDP(object):
 
-    def __init__(self, S=[], A=[], T=[], R=[], gamma=0.95, tau=0.01):
+    # Row and column shift of each grid action, in the order Map.BuildGridWorld uses.
+    GridMoves = [(0, -1), (0, 1), (-1, 0), (1, 0),
+                 (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+    def __init__(self, S=[], A=[], T=[], R=[], gamma=0.95, tau=0.01, Grid=None):
         """
         Markov Decision Process (MDP) class.
 
+        When T is None the MDP is an implicit grid world (see Map.BuildGridWorld):
+        states are numbered row by row, the last state is the dead state, and moves that
+        would leave the grid (in either direction, for diagonals) leave the agent in place.
+        Expected values are then computed by shifting the value grid instead of multiplying by T.
+
         Args:
             S (list): List of states
             A (list): List of actions
@@ -22,6 +34,7 @@ class MDP(object):
             R (matrix): Reward function where R[A,S] is the reward for taking action A in state S
             gamma (float): Future discount
             tau (float): Softmax parameter
+            Grid (list): [width, height, diagonal] of an implicit grid world. Only used when T is None.
 
         Returns:
             MDP object
@@ -29,12 +42,130 @@ class MDP(object):
         self.S = S
         self.A = A
         self.T = T
+        self.Grid = Grid
         self.R = R
         self.gamma = gamma
         self.tau = tau
         self.values = np.zeros((1, len(S)))
         # Where we'll store the softmaxed probabilities
         self.policy = np.zeros((len(A), len(S)))
+        # Log-probabilities of the policy (only built when BuildPolicy is asked for them)
+        self.logpolicy = None
+        # States whose transitions are overridden to move to a sink state no
+        # matter the action (see SubMDP). T itself is never modified.
+        self.Absorbing = {}
+        # Sampling tables for Run(). Transition tables are shared with sub-MDPs
+        # (they ignore absorbing overrides); policy tables are per MDP.
+        self.Samplers = {}
+        self.PolicySamplers = {}
+        # Number of state backups the last solver performed.
+        self.Backups = 0
+
+    def SubMDP(self, Target, Sink, Bonus=0):
+        """
+        Build an MDP where reaching a target state ends the task.
+
+        The new MDP shares the transition matrix with this one: the target's
+        transitions are rerouted to the sink state through an override, so T is never copied.
+
+        Args:
+            Target (int): State that becomes absorbing.
+            Sink (int): State the target moves to after any action (e.g., a dead state).
+            Bonus (float): Reward added to every action taken in the target state.
+
+        Returns:
+            MDP object
+        """
+        subMDP = MDP(self.S, self.A, self.T, self.R.copy(),
+                     self.gamma, self.tau, self.Grid)
+        subMDP.Samplers = self.Samplers
+        subMDP.Absorbing = dict(self.Absorbing)
+        subMDP.Absorbing[Target] = Sink
+        subMDP.R[:, Target] += Bonus
+        return subMDP
+
+    def TransitionRow(self, State):
+        """
+        Get the transition probabilities out of a state, taking absorbing overrides into account.
+
+        Args:
+            State (int): State number
+
+        Returns:
+            Matrix where entry [A,SF] is the probability of moving to SF after taking action A.
+        """
+        if State in self.Absorbing or self.T is None:
+            Row = np.zeros((len(self.A), len(self.S)))
+            for Action in range(len(self.A)):
+                Row[Action, self.Successor(State, Action)] = 1
+            return Row
+        return self.T[State, :, :]
+
+    def Successor(self, State, Action):
+        """
+        Get the most likely state reached after taking an action.
+
+        Args:
+            State (int): State number
+            Action (int): Action number
+
+        Returns:
+            State number (int)
+        """
+        if State in self.Absorbing:
+            return self.Absorbing[State]
+        if self.T is not None:
+            return self.T[State, Action, :].argmax()
+        [width, height, diagonal] = self.Grid
+        if State >= width * height:
+            # Dead state
+            return State
+        [row, col] = divmod(State, width)
+        [drow, dcol] = self.GridMoves[Action]
+        if 0 <= row + drow < height and 0 <= col + dcol < width:
+            return State + drow * width + dcol
+        return State
+
+    def ExpectedValues(self, V):
+        """
+        Compute the expected value of the next state for every state and action.
+
+        Args:
+            V (array): Vector with the value of each state.
+
+        Returns:
+            Matrix where entry [S,A] is the expected value of the state reached after taking action A in state S.
+        """
+        if self.T is None:
+            Expected = self.GridExpectedValues(V)
+        else:
+            Expected = self.T.dot(V)
+        for State in self.Absorbing:
+            Expected[State, :] = V[self.Absorbing[State]]
+        return Expected
+
+    def GridExpectedValues(self, V):
+        """
+        Compute ExpectedValues on an implicit grid by shifting the value grid once per action.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        [width, height, diagonal] = self.Grid
+        Cells = width * height
+        Values = V[:Cells].reshape(height, width)
+        Expected = np.empty((len(self.S), len(self.A)))
+        for Action in range(len(self.A)):
+            [drow, dcol] = self.GridMoves[Action]
+            # Moves off the grid leave the agent in place
+            Shifted = Values.copy()
+            Shifted[max(0, -drow):height - max(0, drow), max(0, -dcol):width - max(0, dcol)] = \
+                Values[max(0, drow):height - max(0, -drow), max(0, dcol):width - max(0, -dcol)]
+            Expected[:Cells, Action] = Shifted.ravel()
+        # The dead state only leads to itself
+        Expected[Cells:, :] = V[Cells:, np.newaxis]
+        return Expected
 
     def ValueIteration(self, epsilon=0.0001):
         """
@@ -49,18 +180,393 @@ class MDP(object):
             None
         """
         self.values = np.zeros(self.values.shape)
+        self.Backups = 0
+        while True:
+            V2 = self.values.copy()
+            self.values[0, :] = (
+                self.R.T + self.gamma * self.ExpectedValues(V2[0, :])).max(axis=1)
+            self.Backups += len(self.S)
+            if (self.values - V2).max() <= epsilon:
+                break
+
+    def Solve(self, Method="ValueIteration", epsilon=0.0001, Sweeps=10):
+        """
+        Calculate each state's value with the chosen solver and save them in MDP's values attribute.
+
+        All solvers stop with the same tolerance, so BuildPolicy() gives the same policy after any of them.
+
+        The number of state backups the solver performed is saved in the Backups attribute
+        (policy evaluation sweeps count one backup per state, even though they only look at one action).
+
+        Args:
+            Method (str): "ValueIteration", "PolicyIteration", "ModifiedPolicyIteration", "GaussSeidel", or "PrioritizedSweeping".
+            epsilon (float): Convergence parameter
+            Sweeps (int): Policy evaluation sweeps per improvement step (ModifiedPolicyIteration only).
+
+        Returns:
+            None
+        """
+        if Method == "ValueIteration":
+            self.ValueIteration(epsilon)
+        elif Method == "PolicyIteration":
+            self.PolicyIteration(epsilon)
+        elif Method == "ModifiedPolicyIteration":
+            self.ModifiedPolicyIteration(epsilon, Sweeps)
+        elif Method == "GaussSeidel":
+            self.GaussSeidel(epsilon)
+        elif Method == "PrioritizedSweeping":
+            self.PrioritizedSweeping(epsilon)
+        else:
+            print("ERROR: Unknown solver " + str(Method) + ". MDP-011")
+
+    def PolicyIteration(self, epsilon=0.0001):
+        """
+        Perform policy iteration on MDP.
+
+        Alternates between evaluating a deterministic policy and making it greedy with respect to
+        its values, until the policy stops changing. Policies are evaluated iteratively (see EvaluatePolicy)
+        so the MDP never builds an SxS linear system.
+
+        Args:
+            epsilon (float): Convergence parameter for each policy evaluation.
+
+        Returns:
+            None
+        """
+        States = np.arange(len(self.S))
+        self.values = np.zeros(self.values.shape)
+        self.Backups = len(self.S)
+        Actions = (self.R.T + self.gamma *
+                   self.ExpectedValues(self.values[0, :])).argmax(axis=1)
+        while True:
+            self.EvaluatePolicy(Actions, epsilon)
+            Q = self.R.T + self.gamma * self.ExpectedValues(self.values[0, :])
+            self.Backups += len(self.S)
+            NewActions = Q.argmax(axis=1)
+            # Only switch actions that are strictly better so ties can't cycle.
+            Keep = Q[States, Actions] >= Q[States, NewActions]
+            NewActions[Keep] = Actions[Keep]
+            if np.array_equal(NewActions, Actions):
+                break
+            Actions = NewActions
+
+    def ModifiedPolicyIteration(self, epsilon=0.0001, Sweeps=10):
+        """
+        Perform modified policy iteration on MDP.
+
+        Each step takes the greedy policy from a value iteration backup and then runs Sweeps - 1 extra
+        evaluation sweeps of that policy (which are cheaper than a full backup because they only look at one action).
+        Stops under the same condition as ValueIteration().
+
+        Args:
+            epsilon (float): Convergence parameter
+            Sweeps (int): Evaluation sweeps per improvement step. Sweeps=1 is value iteration.
+
+        Returns:
+            None
+        """
+        States = np.arange(len(self.S))
+        self.values = np.zeros(self.values.shape)
+        self.Backups = 0
         while True:
             V2 = self.values.copy()
-            for i in range(0, len(self.S)):
-                prod = self.gamma * \
-                    (np.mat(self.T[i, :, :]) * np.mat(V2.transpose()))
-                self.values[0, i] = max(prod[j] + self.R[j, i]
-                                        for j in range(len(self.A)))
-                # options = [(self.R[j, i] + self.gamma * (np.mat(self.T[i, :, :]))
-                #            * np.mat(V2.transpose())).max() for j in range(len(self.A))]
-                #self.values[0, i] = max(options)
+            Q = self.R.T + self.gamma * self.ExpectedValues(V2[0, :])
+            Actions = Q.argmax(axis=1)
+            self.values[0, :] = Q[States, Actions]
+            self.Backups += len(self.S)
             if (self.values - V2).max() <= epsilon:
                 break
+            self.EvaluatePolicy(Actions, epsilon, Sweeps - 1)
+
+    def EvaluatePolicy(self, Actions, epsilon=0.0001, Sweeps=None):
+        """
+        Iteratively evaluate a deterministic policy, starting from the current values.
+
+        Args:
+            Actions (array): Action taken in each state.
+            epsilon (float): Stop when no value changes more than epsilon in a sweep.
+            Sweeps (int): Maximum number of sweeps. When None the function runs until convergence.
+
+        Returns:
+            None
+        """
+        States = np.arange(len(self.S))
+        Rewards = self.R[Actions, States]
+        if self.T is None:
+            Next = self.GridSuccessors(Actions)
+        else:
+            Next = None
+            TPolicy = self.T[States, Actions, :]
+            for State in self.Absorbing:
+                TPolicy[State, :] = 0
+                TPolicy[State, self.Absorbing[State]] = 1
+        Sweep = 0
+        while Sweeps is None or Sweep < Sweeps:
+            V2 = self.values.copy()
+            if Next is None:
+                self.values[0, :] = Rewards + self.gamma * TPolicy.dot(V2[0, :])
+            else:
+                self.values[0, :] = Rewards + self.gamma * V2[0, Next]
+            self.Backups += len(self.S)
+            Sweep += 1
+            if np.abs(self.values - V2).max() <= epsilon:
+                break
+
+    def GaussSeidel(self, epsilon=0.0001):
+        """
+        Perform in-place (Gauss-Seidel) value iteration, sweeping outwards from the absorbing states.
+
+        States are grouped in layers by how many steps they are from an absorbing state (see DistanceLayers).
+        Each sweep backs up the layers in order and every layer already sees the values its inner neighbors got in the same sweep,
+        so the target's reward reaches the whole map in a single sweep. States within a layer are backed up together.
+        Stops under the same condition as ValueIteration().
+
+        Args:
+            epsilon (float): Convergence parameter
+
+        Returns:
+            None
+        """
+        [Next, Prob] = self.SuccessorTable()
+        Rewards = self.R.T
+        Layers = self.DistanceLayers(Next, Prob)
+        self.values = np.zeros(self.values.shape)
+        self.Backups = 0
+        Values = self.values[0, :]
+        while True:
+            Change = -np.inf
+            for Layer in Layers:
+                Old = Values[Layer]
+                Values[Layer] = (Rewards[Layer] + self.gamma *
+                                 (Prob[Layer] * Values[Next[Layer]]).sum(axis=2)).max(axis=1)
+                self.Backups += len(Layer)
+                Change = max(Change, (Values[Layer] - Old).max())
+            if Change <= epsilon:
+                break
+
+    def PrioritizedSweeping(self, epsilon=0.0001):
+        """
+        Perform prioritized sweeping.
+
+        States are backed up one at a time, always picking the state whose value is furthest from its Bellman backup.
+        After a backup only the state's predecessors can change, so only they are re-checked.
+        Stops when no state's backup would change its value by more than epsilon.
+
+        Args:
+            epsilon (float): Convergence parameter
+
+        Returns:
+            None
+        """
+        [Next, Prob] = self.SuccessorTable()
+        Rewards = self.R.T
+        Predecessors = self.SuccessorGraph(Next, Prob).T.tocsr()
+        self.values = np.zeros(self.values.shape)
+        Values = self.values[0, :]
+        Backup = (Rewards + self.gamma *
+                  (Prob * Values[Next]).sum(axis=2)).max(axis=1)
+        self.Backups = len(self.S)
+        # Priority queue of (-error, state). Entries go stale when a state is
+        # pushed again with a new error, so Errors keeps the current one.
+        Errors = np.abs(Backup - Values)
+        Queue = [(-Errors[State], State)
+                 for State in range(len(self.S)) if Errors[State] > epsilon]
+        heapq.heapify(Queue)
+        while len(Queue) > 0:
+            [Error, State] = heapq.heappop(Queue)
+            if -Error != Errors[State]:
+                continue
+            Values[State] = (Rewards[State] + self.gamma *
+                             (Prob[State] * Values[Next[State]]).sum(axis=1)).max()
+            self.Backups += 1
+            Errors[State] = 0
+            for Predecessor in Predecessors.indices[Predecessors.indptr[State]:Predecessors.indptr[State + 1]]:
+                Error = abs((Rewards[Predecessor] + self.gamma *
+                             (Prob[Predecessor] * Values[Next[Predecessor]]).sum(axis=1)).max() - Values[Predecessor])
+                if Error > epsilon:
+                    Errors[Predecessor] = Error
+                    heapq.heappush(Queue, (-Error, Predecessor))
+
+    def SuccessorTable(self):
+        """
+        List the states each action can lead to, taking absorbing overrides into account.
+
+        Returns:
+            [Next, Prob] where Next[S,A,K] is the K-th state action A can lead to from state S and
+            Prob[S,A,K] its probability. K is the largest number of outcomes any action has
+            (padding entries have probability 0).
+        """
+        [Next, Prob] = self.TransitionSampler()[:2]
+        if self.Absorbing == {}:
+            return [Next, Prob]
+        Next = Next.copy()
+        Prob = Prob.copy()
+        for State in self.Absorbing:
+            Next[State, :, :] = self.Absorbing[State]
+            Prob[State, :, :] = 0
+            Prob[State, :, 0] = 1
+        return [Next, Prob]
+
+    def TransitionSampler(self):
+        """
+        Successor table of the transitions without absorbing overrides, and alias tables to sample from it.
+        The tables are built the first time they are needed and shared with every sub-MDP built from this MDP.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Returns:
+            [Next, Prob, AliasProb, Alias] (see SuccessorTable() and AliasTable()).
+            When transitions are deterministic (K=1) the alias tables are None.
+        """
+        if "Transitions" in self.Samplers:
+            return self.Samplers["Transitions"]
+        if self.T is None:
+            Absorbing = self.Absorbing
+            self.Absorbing = {}
+            Next = np.zeros((len(self.S), len(self.A), 1), dtype=int)
+            for Action in range(len(self.A)):
+                Next[:, Action, 0] = self.GridSuccessors(
+                    np.full(len(self.S), Action))
+            self.Absorbing = Absorbing
+            Prob = np.ones(Next.shape)
+        elif np.all(self.T.max(axis=2) == 1):
+            # Deterministic transitions
+            Next = self.T.argmax(axis=2)[:, :, np.newaxis]
+            Prob = np.ones(Next.shape)
+        else:
+            Support = self.T > 0
+            K = max(Support.sum(axis=2).max(), 1)
+            Next = np.argsort(~Support, axis=2, kind="stable")[:, :, :K]
+            Prob = np.take_along_axis(self.T, Next, axis=2)
+        if Next.shape[2] == 1:
+            Sampler = [Next, Prob, None, None]
+        else:
+            [AliasProb, Alias] = self.AliasTable(
+                Prob.reshape(-1, Prob.shape[2]))
+            Sampler = [Next, Prob, AliasProb.reshape(Prob.shape), Alias.reshape(Prob.shape)]
+        self.Samplers["Transitions"] = Sampler
+        return Sampler
+
+    def PolicySampler(self, Softmax=True):
+        """
+        Tables to sample actions from the current policy in constant time.
+        Tables are rebuilt when the policy array is replaced (e.g., by BuildPolicy()
+        or when a planner swaps policies), and kept for the last few policies used.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Softmax (bool): Sample from the policy's probabilities? Otherwise, sample among the highest-probability actions.
+
+        Returns:
+            [AliasProb, Alias] (see AliasTable()) when Softmax is True.
+            [Ties, TieCounts] otherwise, where Ties[S] lists the highest-probability actions in state S first and
+            TieCounts[S] says how many there are.
+        """
+        Key = (id(self.policy), Softmax)
+        if Key in self.PolicySamplers and self.PolicySamplers[Key][0] is self.policy:
+            return self.PolicySamplers[Key][1]
+        if len(self.PolicySamplers) >= 64:
+            self.PolicySamplers = {}
+        if Softmax:
+            Table = self.AliasTable(self.policy.T)
+        else:
+            Best = (self.policy == self.policy.max(axis=0)).T
+            Table = [np.argsort(~Best, axis=1, kind="stable"), Best.sum(axis=1)]
+        self.PolicySamplers[Key] = [self.policy, Table]
+        return Table
+
+    def AliasTable(self, Probabilities):
+        """
+        Build alias tables (Walker's alias method) for every row of a probability matrix.
+
+        To sample from row i draw a column j uniformly at random and keep it with probability AliasProb[i, j];
+        otherwise take Alias[i, j].
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Probabilities (matrix): Matrix where each row is a probability distribution.
+
+        Returns:
+            [AliasProb, Alias]
+        """
+        [Rows, K] = Probabilities.shape
+        RowIndices = np.arange(Rows)
+        Mass = Probabilities * (K / Probabilities.sum(axis=1))[:, np.newaxis]
+        AliasProb = np.ones((Rows, K))
+        Alias = np.tile(np.arange(K), (Rows, 1))
+        Done = np.zeros((Rows, K), dtype=bool)
+        # Each pass pairs every row's smallest remaining column with its largest one.
+        for Pass in range(K - 1):
+            Small = np.where(Done, np.inf, Mass).argmin(axis=1)
+            Done[RowIndices, Small] = True
+            Large = np.where(Done, -np.inf, Mass).argmax(axis=1)
+            AliasProb[RowIndices, Small] = Mass[RowIndices, Small]
+            Alias[RowIndices, Small] = Large
+            Mass[RowIndices, Large] -= 1 - Mass[RowIndices, Small]
+        return [AliasProb, Alias]
+
+    def SuccessorGraph(self, Next, Prob):
+        """
+        Build a sparse matrix whose entry [SO,SF] is nonzero when some action can move the agent from SO to SF.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        Origins = np.broadcast_to(
+            np.arange(len(self.S))[:, np.newaxis, np.newaxis], Next.shape)
+        Possible = Prob > 0
+        return scipy.sparse.csr_matrix((np.ones(Possible.sum()), (Origins[Possible], Next[Possible])),
+                                       shape=(len(self.S), len(self.S)))
+
+    def DistanceLayers(self, Next, Prob):
+        """
+        Group states by the number of steps they need to reach an absorbing state.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Returns:
+            List of arrays of states, closest layer first. States that can't reach
+            an absorbing state (or all states, if there are none) go in the last layer.
+        """
+        if self.Absorbing == {}:
+            return [np.arange(len(self.S))]
+        Distances = scipy.sparse.csgraph.dijkstra(self.SuccessorGraph(Next, Prob).T, indices=list(self.Absorbing.keys()),
+                                                  unweighted=True, min_only=True)
+        Distances[np.isinf(Distances)] = Distances[~np.isinf(Distances)].max() + 1
+        Order = np.argsort(Distances, kind="stable")
+        Splits = np.nonzero(np.diff(Distances[Order]))[0] + 1
+        return np.split(Order, Splits)
+
+    def GridSuccessors(self, Actions):
+        """
+        Vectorized Successor() for an implicit grid, with one action per state.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        [width, height, diagonal] = self.Grid
+        States = np.arange(len(self.S))
+        Moves = np.array(self.GridMoves)[Actions]
+        [rows, cols] = np.divmod(States, width)
+        Inside = (States < width * height) & \
+            (rows + Moves[:, 0] >= 0) & (rows + Moves[:, 0] < height) & \
+            (cols + Moves[:, 1] >= 0) & (cols + Moves[:, 1] < width)
+        Next = np.where(Inside, States + Moves[:, 0] * width + Moves[:, 1], States)
+        for State in self.Absorbing:
+            Next[State] = self.Absorbing[State]
+        return Next
 
     def Validate(self):
         """
@@ -70,7 +576,13 @@ class MDP(object):
             None
         """
         print("Validating MDP...")
-        dims = self.T.shape
+        if self.T is None:
+            if self.Grid is None or len(self.S) != self.Grid[0] * self.Grid[1] + 1:
+                print("ERROR: Implicit grid does not match number of states. MDP-010")
+                return 0
+            dims = [len(self.S), len(self.A), len(self.S)]
+        else:
+            dims = self.T.shape
         states = len(self.S)
         actions = len(self.A)
         if (dims[0] != dims[2]):
@@ -96,52 +608,44 @@ class MDP(object):
                 print("ERROR: Invalida value of tau. MDP-009")
                 return 0
         # Check that every vector adds up to 1
+        if self.T is None:
+            # Grid transitions are deterministic by construction.
+            return 1
         res = (np.ndarray.flatten(np.sum(self.T, axis=2)) == 1)
         if len(res) != sum(res):
             print("ERROR: Transition matrix rows do not add up to 1. MDP-007")
             return 0
         return 1
 
-    def BuildPolicy(self, Softmax=True):
+    def BuildPolicy(self, Softmax=True, Log=False):
         """
         Build optimal policy
 
-        Calculates MDPs optimal policy
+        Calculates MDPs optimal policy. Softmaxed policies are computed with log-sum-exp over all states at once,
+        so small values of tau don't overflow or underflow.
 
         Args:
             Softmax (bool): Indicates if actions are softmaxed.
+            Log (bool): Also save the log-probabilities in the logpolicy attribute.
 
         Returns:
             None
         """
         # Build a policy using the results from value iteration
-        for i in range(0, len(self.S)):
-            options = np.mat(
-                self.T[i, :, :]) * np.mat(self.values.transpose())
-            options = options.tolist()
-            # Prevent softmax from overflowing
-            maxval = abs(max(options)[0])
-            options = [options[j][0] - maxval for j in range(len(options))]
-            # Softmax the policy
-            if Softmax:
-                try:
-                    options = [math.exp(options[j] / self.tau)
-                               for j in range(len(options))]
-                except OverflowError:
-                    print("ERROR: Failed to softmax policy. MDP-008")
-                    raise
-                # If all actions have no value then set a uniform distribution
-                if sum(options) == 0:
-                    self.policy[:, i] = [
-                        1.0 / len(options) for j in range(len(options))]
-                else:
-                    self.policy[:, i] = [
-                        options[j] / sum(options) for j in range(len(options))]
-            else:
-                totalchoices = sum([options[optloop] == max(options)
-                                    for optloop in range(len(options))])
-                self.policy[:, i] = [(1.0 / totalchoices if options[optloop] == max(options) else 0)
-                                     for optloop in range(len(options))]
+        Options = self.ExpectedValues(self.values[0, :]).T
+        if Softmax:
+            Options = Options / self.tau
+            LogPolicy = Options - scipy.special.logsumexp(Options, axis=0)
+            self.policy = np.exp(LogPolicy)
+        else:
+            # Split the probability evenly among the highest-value actions
+            Best = (Options == Options.max(axis=0))
+            self.policy = Best / Best.sum(axis=0, dtype=float)
+            if Log:
+                with np.errstate(divide="ignore"):
+                    LogPolicy = np.log(self.policy)
+        if Log:
+            self.logpolicy = LogPolicy
 
     def GetStates(self, StartingPoint, ActionSequence):
         """
@@ -157,14 +661,16 @@ class MDP(object):
         StateSequence = [0] * (len(ActionSequence) + 1)
         StateSequence[0] = StartingPoint
         for i in range(len(ActionSequence)):
-            StateSequence[i + 1] = (
-                self.T[StateSequence[i], ActionSequence[i], :]).argmax()
+            StateSequence[i + 1] = self.Successor(
+                StateSequence[i], ActionSequence[i])
         return StateSequence
 
     def Run(self, State, Softmax=False, Simple=False):
         """
         Sample an action from the optimal policy given the state.
         Note that if softmax is set to true then Simple is ignored (see below).
+        Actions and next states are drawn from precomputed tables (see PolicySampler() and TransitionSampler())
+        so each call takes constant time.
 
         Args:
             State (int): State number where agent begins.
@@ -178,33 +684,27 @@ class MDP(object):
         """
         if Softmax:
             # If softmaxing then select a random sample
-            ActSample = random.uniform(0, 1)
-            ActionProbs = self.policy[:, State]
-            ActionChoice = -1
-            for j in range(len(ActionProbs)):
-                if ActSample < ActionProbs[j]:
-                    ActionChoice = j
-                    break
-                else:
-                    ActSample -= ActionProbs[j]
+            [AliasProb, Alias] = self.PolicySampler(True)
+            ActionChoice = int(random.random() * len(self.A))
+            if random.random() >= AliasProb[State, ActionChoice]:
+                ActionChoice = Alias[State, ActionChoice]
         else:
-            maxval = max(self.policy[:, State])
-            maxindices = [
-                i for i, j in enumerate(self.policy[:, State]) if j == maxval]
+            [Ties, TieCounts] = self.PolicySampler(False)
             if Simple:
-                ActionChoice = maxindices[0]
+                ActionChoice = Ties[State, 0]
             else:
-                ActionChoice = random.choice(maxindices)
+                ActionChoice = Ties[State, random.randrange(TieCounts[State])]
+        ActionChoice = int(ActionChoice)
         # Now find the next state
-        EndStates = self.T[State, ActionChoice, :]
-        StateSample = random.uniform(0, 1)
-        for j in range(len(EndStates)):
-            if StateSample < EndStates[j]:
-                EndState = j
-                break
-            else:
-                StateSample -= EndStates[j]
-        return [EndState, ActionChoice]
+        if State in self.Absorbing:
+            return [self.Absorbing[State], ActionChoice]
+        [Next, Prob, AliasProb, Alias] = self.TransitionSampler()
+        if AliasProb is None:
+            return [int(Next[State, ActionChoice, 0]), ActionChoice]
+        Outcome = int(random.random() * Next.shape[2])
+        if random.random() >= AliasProb[State, ActionChoice, Outcome]:
+            Outcome = Alias[State, ActionChoice, Outcome]
+        return [int(Next[State, ActionChoice, Outcome]), ActionChoice]
 
     def Display(self, Full=False):
         """
@@ -62,16 +62,25 @@ class Map(object):
         Check if Map object has everything it needs.
         """
         Success = True
-        Tshape = self.T.shape
-        if Tshape[0] != Tshape[2]:
-            print("ERROR: Transition matrix has wrong dimensions. MAP-001")
-            Success = False
-        if Tshape[0] != len(self.S) + 1:  # 1 for the dead state!
-            print("ERROR: Transition matrix does not match number of states. MAP-002")
-            Success = False
-        if Tshape[1] != len(self.A):
-            print("ERROR: Transition matrix does not match number of actions. MAP-003")
-            Success = False
+        if self.T is None:
+            # Implicit grid: transitions are computed from the map's shape.
+            if self.mapwidth * self.mapheight != len(self.S):
+                print("ERROR: Implicit transitions do not match number of states. MAP-023")
+                Success = False
+            if len(self.A) not in [4, 8]:
+                print("ERROR: Implicit transitions do not match number of actions. MAP-024")
+                Success = False
+        else:
+            Tshape = self.T.shape
+            if Tshape[0] != Tshape[2]:
+                print("ERROR: Transition matrix has wrong dimensions. MAP-001")
+                Success = False
+            if Tshape[0] != len(self.S) + 1:  # 1 for the dead state!
+                print("ERROR: Transition matrix does not match number of states. MAP-002")
+                Success = False
+            if Tshape[1] != len(self.A):
+                print("ERROR: Transition matrix does not match number of actions. MAP-003")
+                Success = False
         # Check that location and locationtype match
         if len(self.ObjectLocations) == 0 or len(self.ObjectTypes) == 0:
             print("ERROR: Missing object locations. MAP-004")
@@ -110,20 +119,26 @@ class Map(object):
         if self.ExitState in self.ObjectLocations:
             print("ERROR: Cannot have object on exit state. MAP-022")
         # Check that transition matrix makes sense
-        if sum([np.all(np.sum(self.T[:, i, :], axis=1) == 1) for i in range(len(self.A))]) != len(self.A):
-            print("ERROR: Transition matrix is not well formed. MAP-011")
-            Success = False
+        if self.T is not None:
+            if sum([np.all(np.sum(self.T[:, i, :], axis=1) == 1) for i in range(len(self.A))]) != len(self.A):
+                print("ERROR: Transition matrix is not well formed. MAP-011")
+                Success = False
         return Success
 
-    def BuildGridWorld(self, x, y, diagonal=True):
+    def BuildGridWorld(self, x, y, diagonal=True, Implicit=False):
         """
         Build a simple grid world with a noiseless transition matrix and an unreachable dead.
         Planner objects take advantage of the dead state to build MDPs that converge faster.
 
+        The transition matrix has (x*y+1)^2 entries per action, which is too much for large maps.
+        With Implicit set to True the map stores no transition matrix (T is None) and the MDPs
+        built from it compute transitions as shifts over the grid instead (see MDP's Grid argument).
+
         Args:
             x (int): Map's length
             y (int): Map's height
             diagonal (bool): Can the agent travel diagonally?
+            Implicit (bool): Skip building the transition matrix.
         """
         self.mapwidth = x
         self.mapheight = y
@@ -140,6 +155,9 @@ class Map(object):
         if self.ObjectNames == []:
             self.ObjectNames = [
                 "Object " + str(i) for i in set(self.ObjectTypes)]
+        if Implicit:
+            self.T = None
+            return
         # From, With, To. Add one for the dead state
         self.T = np.zeros((len(self.S) + 1, len(self.A), len(self.S) + 1))
         # First create dead state structure. All actions leave agent in same
@@ -236,6 +254,20 @@ class Map(object):
         """
         return len(self.S)
 
+    def GetGrid(self):
+        """
+        Get the grid description MDPs need when the map has no transition matrix.
+
+        Args:
+            None
+
+        Returns:
+            [width, height, diagonal] when transitions are implicit, None otherwise.
+        """
+        if self.T is not None:
+            return None
+        return [self.mapwidth, self.mapheight, self.diagonal]
+
     def NumberOfActions(self):
         """
         Get number of actions
@@ -12,8 +12,15 @@ import math
 from . import PosteriorContainer
 from . import AgentSimulation
 from . import AuxiliaryFunctions
+from . import LikelihoodSurrogate
+from . import PosteriorReducer
 import scipy.special
-from scipy.stats.stats import pearsonr
+import os
+import json
+import random
+import pickle
+import time
+import multiprocessing
 
 
 class Observer(object):
@@ -35,100 +42,170 @@ class Observer(object):
         self.endcolor = '\033[0m'
         self.block = '\u2588'
 
-    def TestModel(self, Simulations, Samples, Return=False, Verbose=True):
+    def TestModel(self, Simulations, Samples, Return=False, Verbose=True, Processes=1, Output=None, BaseSeed=None, Cache=None):
         """
         Simulate N agents, infer their parameters, and then correlate the inferred values with the true values.
 
+        Each agent is an independent task (see TestAgent()): the i-th agent seeds the random number generators with BaseSeed + i,
+        samples its costs and rewards, acts, has its parameters inferred, and is simulated again with the inferred values.
+        Tasks run on a pool of processes and, when an Output file is given, each agent's results are appended to it
+        as soon as they are ready. Running TestModel again with the same Output file resumes the test:
+        agents already in the file are skipped and the file's BaseSeed is reused.
+
         Simulations (int): Number of agents to Simulate
         Samples (int): Number of samples to use in each simulation
         Return (bool): When set to true the function returns the data
         Verbose (bool): Print progress bar?
+        Processes (int): Number of processes to use.
+        Output (str): (optional) File where results are streamed (one JSON object per line).
+        BaseSeed (int): (optional) Seed for the first agent. When None a random seed is used.
+        Cache (bool): Reuse plans when inference draws the same costs more than once (see Planner.EnablePlanCache()).
+                      The cache is shared by all the agents a process tests, and results don't depend on how agents
+                      are split across processes. When None it's only used if the cost prior has a finite support
+                      (with continuous priors costs never repeat) and the agent's actions aren't softmaxed.
         """
         if Verbose is False and Return is False:
             sys.stdout.write(
                 "ERROR: The function is set on silent and return no input.")
             return None
-        if Verbose:
-            sys.stdout.write("Simulating agents...\n")
-            sys.stdout.flush()
-        Agents = self.SimulateAgents(Simulations, False, True, False, True)
-        if Verbose:
-            sys.stdout.write("\n\nRunning inference...\n")
-            sys.stdout.flush()
-        InferredCosts = [0] * Simulations
-        InferredRewards = [0] * Simulations
-        for i in range(Simulations):
+        Completed = {}
+        # Empty files (e.g., created in advance) start a new test
+        if Output is not None and os.path.isfile(Output) and os.path.getsize(Output) > 0:
+            with open(Output, "r") as OutputFile:
+                Header = json.loads(OutputFile.readline())
+                for line in OutputFile:
+                    if line.strip() != "":
+                        Result = json.loads(line)
+                        Completed[Result["Index"]] = Result
+            if Header["Samples"] != Samples:
+                sys.stdout.write("ERROR: " + Output + " was created with " + str(Header["Samples"]) +
+                                 " samples per inference. Resume it with the same number of samples or use a new file.\n")
+                return None
+            BaseSeed = Header["BaseSeed"]
             if Verbose:
-                Percentage = round(i * 100.0 / Simulations, 2)
-                sys.stdout.write("\rInferring agent " + str(i + 1) + " |")
-                roundper = int(math.floor(Percentage / 5))
-                sys.stdout.write(
-                    self.begincolor + self.block * roundper + self.endcolor)
-                sys.stdout.write(" " * (20 - roundper))
-                sys.stdout.write("| " + str(Percentage) + "%")
-                sys.stdout.flush()
-            Results = self.InferAgent(Agents.Actions[i], Samples)
-            InferredCosts[i] = Results.GetExpectedCosts()
-            InferredRewards[i] = Results.GetExpectedRewards()
+                sys.stdout.write("Resuming test: " + str(len(Completed)) +
+                                 " agents already completed.\n")
+        if BaseSeed is None:
+            BaseSeed = int(np.random.randint(2 ** 31 - Simulations))
+        OutputFile = None
+        if Output is not None:
+            OutputFile = open(Output, "a")
+            if Completed == {} and OutputFile.tell() == 0:
+                OutputFile.write(json.dumps(
+                    {"BaseSeed": BaseSeed, "Samples": Samples}) + "\n")
+                OutputFile.flush()
+        if Cache is None:
+            # Plans with softmaxed actions are never cached
+            Cache = not self.Plr.Agent.SoftmaxAction and self.Plr.Agent.PriorSupport(
+                self.Plr.Agent.CostDimensions, self.Plr.Agent.CostParams, self.Plr.Agent.CostPrior, self.Plr.Agent.CNull) is not None
+        Tasks = [(i, Samples, BaseSeed + i)
+                 for i in range(Simulations) if i not in Completed]
         if Verbose:
-            # Print complete progress bar
-            sys.stdout.write("\rInferring agent " + str(Simulations) + " |")
-            sys.stdout.write(self.begincolor + self.block * 20 + self.endcolor)
-            sys.stdout.write("| 100.0%")
+            sys.stdout.write("Testing model on " + str(len(Tasks)) + " agents...\n")
             sys.stdout.flush()
+        # Only clear the cache afterwards if it was enabled here
+        ClearCache = Cache and self.Plr.PlanCache is None
+        try:
+            if Processes > 1:
+                Pool = multiprocessing.Pool(
+                    Processes, InitializeTestWorker, (self, Cache))
+                Results = Pool.imap_unordered(RunTestWorker, Tasks)
+            else:
+                Pool = None
+                if Cache:
+                    self.Plr.EnablePlanCache()
+                Results = (self.TestAgent(*Task) for Task in Tasks)
+            for Result in Results:
+                Completed[Result["Index"]] = Result
+                if OutputFile is not None:
+                    OutputFile.write(json.dumps(Result) + "\n")
+                    OutputFile.flush()
+                if Verbose:
+                    Percentage = round(len(Completed) * 100.0 / Simulations, 2)
+                    sys.stdout.write("\rProgress |")
+                    roundper = int(math.floor(Percentage / 5))
+                    sys.stdout.write(
+                        self.begincolor + self.block * roundper + self.endcolor)
+                    sys.stdout.write(" " * (20 - roundper))
+                    sys.stdout.write("| " + str(Percentage) + "%")
+                    sys.stdout.flush()
+            if Pool is not None:
+                Pool.close()
+                Pool.join()
+        finally:
+            if OutputFile is not None:
+                OutputFile.close()
+            if ClearCache:
+                self.Plr.ClearPlanCache()
+        Results = [Completed[i] for i in range(Simulations) if i in Completed]
+        MatchingActions = [Result["Match"] for Result in Results]
+        if Verbose:
             sys.stdout.write("\n")
             # Calculate correlations
-            TrueCosts = [item for sublist in Agents.Costs for item in sublist]
+            from scipy.stats import pearsonr
+            TrueCosts = [item for Result in Results for item in Result["Costs"]]
             TrueRewards = [
-                item for sublist in Agents.Rewards for item in sublist]
+                item for Result in Results for item in Result["Rewards"]]
             InferenceCosts = [
-                item for sublist in InferredCosts for item in sublist]
+                item for Result in Results for item in Result["InferredCosts"]]
             InferenceRewards = [
-                item for sublist in InferredRewards for item in sublist]
+                item for Result in Results for item in Result["InferredRewards"]]
             sys.stdout.write(
                 "Costs correlation: " + str(pearsonr(TrueCosts, InferenceCosts)[0]) + "\n")
             sys.stdout.write(
                 "Rewards correlation: " + str(pearsonr(TrueRewards, InferenceRewards)[0]) + "\n\n")
-        # For each sample get the sequence of actions with the highest
-        # likelihood
-        if Verbose:
-            sys.stdout.write(
-                "Using inferred expected values to predict actions...\n")
-        PredictedActions = [0] * Simulations
-        MatchingActions = [0] * Simulations
-        for i in range(Simulations):
-            if Verbose:
-                Percentage = round(i * 100.0 / Simulations, 2)
-                sys.stdout.write("\rSimulating agent " + str(i + 1) + " |")
-                roundper = int(math.floor(Percentage / 5))
-                sys.stdout.write(
-                    self.begincolor + self.block * roundper + self.endcolor)
-                sys.stdout.write(" " * (20 - roundper))
-                sys.stdout.write("| " + str(Percentage) + "%")
-                sys.stdout.flush()
-            self.Plr.Agent.costs = InferredCosts[i]
-            self.Plr.Agent.rewards = InferredRewards[i]
-            self.Plr.Prepare(self.Validate)
-            result = self.Plr.Simulate()
-            PredictedActions[i] = result[0]
-            if result[0] == Agents.Actions[i]:
-                MatchingActions[i] = 1
-        if Verbose:
-            # Print complete progress bar
-            sys.stdout.write("\rSimulating agent " + str(Simulations) + " |")
-            sys.stdout.write(self.begincolor + self.block * 20 + self.endcolor)
-            sys.stdout.write("| 100.0%")
-            sys.stdout.flush()
-            sys.stdout.write("\n")
-            sys.stdout.write(str(sum(MatchingActions) * 100.00 / Simulations) +
+            sys.stdout.write(str(sum(MatchingActions) * 100.00 / len(Results)) +
                              "% of inferences produced the observed actions.\n")
         if Return:
-            InferredAgents = AgentSimulation.AgentSimulation(
-                InferredCosts, InferredRewards, PredictedActions, None)
+            Agents = AgentSimulation.AgentSimulation([Result["Costs"] for Result in Results], [Result["Rewards"] for Result in Results], [
+                                                     Result["Actions"] for Result in Results], [Result["States"] for Result in Results], self.Plr.Map.ObjectNames, self.Plr.Map.StateNames)
+            InferredAgents = AgentSimulation.AgentSimulation([Result["InferredCosts"] for Result in Results], [
+                                                             Result["InferredRewards"] for Result in Results], [Result["PredictedActions"] for Result in Results], None)
             return [Agents, InferredAgents, MatchingActions]
         else:
             return None
 
+    def TestAgent(self, Index, Samples, Seed):
+        """
+        Simulate one agent, infer its parameters, and check if the inferred parameters produce the same actions.
+
+        .. Warning::
+
+           This function is for internal use only. See TestModel().
+
+        Args:
+            Index (int): Agent number
+            Samples (int): Number of samples to use in the inference
+            Seed (int): Seed for the random number generators
+
+        Returns:
+            Dictionary with the agent's true and inferred parameters, actions, and whether the actions match.
+        """
+        random.seed(Seed)
+        np.random.seed(Seed)
+        # Simulate
+        self.Plr.Agent.ResampleAgent()
+        Costs = np.asarray(self.Plr.Agent.costs, dtype=float).tolist()
+        Rewards = np.asarray(self.Plr.Agent.rewards, dtype=float).tolist()
+        self.Plr.Prepare(self.Validate)
+        [Actions, States] = self.Plr.Simulate(False)
+        # Infer
+        Results = self.InferAgent(Actions, Samples)
+        InferredCosts = Results.GetExpectedCosts()
+        InferredRewards = Results.GetExpectedRewards()
+        # Predict
+        self.Plr.Agent.costs = InferredCosts
+        self.Plr.Agent.rewards = InferredRewards
+        self.Plr.Prepare(self.Validate)
+        PredictedActions = self.Plr.Simulate()[0]
+        return {"Index": Index, "Seed": Seed,
+                "Costs": Costs, "Rewards": Rewards,
+                "Actions": [int(x) for x in Actions], "States": [int(x) for x in States],
+                "InferredCosts": [float(x) for x in InferredCosts],
+                "InferredRewards": [float(x) for x in InferredRewards],
+                "PredictedActions": [int(x) for x in PredictedActions],
+                "Match": int(list(PredictedActions) == list(Actions))}
+
     def DrawMap(self, filename, ActionSequence=[], size=20):
         """
         Save map as an image.
@@ -185,16 +262,20 @@ class Observer(object):
         Args:
             ActionSequence (list): Sequence of actions
             PC (PosteriorContainer): PosteriorContainer object
-            TestVariable (string): Random variable to test. Must exist in both containers.
+            TestVariable (string or list): Random variable to test. Must exist in both containers.
+                Pass a list to test many variables against the same updated experience.
             Conditioning (list of strings): Random variable names to fix across events. Must exist in both containers.
             Tolerance (int): How many decimal points should be left when rounding? When Tolerance=None samples aren't rounded.
             Feedback (bool): Verbose?
+
+        Returns:
+            [ProbabilitySame, ProbabilityDifferent] (a list of them when TestVariable is a list)
         """
         R = self.UpdateExperience(
-            ActionSequence, PC, Conditioning, Feedback)
+            ActionSequence, PC, Conditioning, Feedback=Feedback)
         return AuxiliaryFunctions.ProbabilityOfChange(PC, R[0], TestVariable, Tolerance)
 
-    def UpdateExperience(self, ActionSequence, PC, Conditioning, Normalize=True, Feedback=True):
+    def UpdateExperience(self, ActionSequence, PC, Conditioning, Normalize=True, Feedback=True, Checkpoint=None, CheckpointEvery=1000, Resume=None):
         """
         This function returns the probability that an agent was knowledgeable or ignorant
         about a cost or a reward, conditioned on them being knowledgeable about one or more sources
@@ -206,6 +287,9 @@ class Observer(object):
             Conditioning (list of strings): Random variable names to fix across events. Must exist in both containers.
             Normalize (bool): Normalize samples?
             Feedback (bool): Verbose?
+            Checkpoint (str): (optional) File where progress is saved every CheckpointEvery samples (see ResumeInference()).
+            CheckpointEvery (int): Number of samples between checkpoints.
+            Resume (dict): Checkpoint to continue from. For internal use only; use ResumeInference() instead.
         """
         if not all(isinstance(x, int) for x in ActionSequence):
             if all(isinstance(x, str) for x in ActionSequence):
@@ -215,9 +299,7 @@ class Observer(object):
                     "ERROR: Action sequence must contains the indices of actions or their names.")
                 return None
         Samples = PC.Samples
-        Costs = [0] * Samples
-        Rewards = [0] * Samples
-        LogLikelihoods = [0] * Samples
+        [Start, Costs, Rewards, LogLikelihoods] = self.StartSamples(Samples, Resume)
         # Find the indices of the dimensions we're locking down (i.e. the agent
         # already knows them).
         RIndices = []
@@ -227,9 +309,13 @@ class Observer(object):
                 RIndices.append(PC.ObjectNames.index(ConditioningVar))
             else:
                 CIndices.append(PC.CostNames.index(ConditioningVar))
+        Arguments = {"ActionSequence": ActionSequence, "PC": PC, "Conditioning": Conditioning,
+                     "Normalize": Normalize, "Feedback": Feedback, "CheckpointEvery": CheckpointEvery}
         if Feedback:
             sys.stdout.write("\n")
-        for i in range(Samples):
+        for i in range(Start, Samples):
+            if Checkpoint is not None and i > Start and i % CheckpointEvery == 0:
+                self.SaveCheckpoint(Checkpoint, "UpdateExperience", Arguments, i, Costs, Rewards, LogLikelihoods)
             if Feedback:
                 Percentage = round(i * 100.0 / Samples, 2)
                 sys.stdout.write("\rProgress |")
@@ -266,19 +352,9 @@ class Observer(object):
             sys.stdout.write(self.begincolor + self.block * 20 + self.endcolor)
             sys.stdout.write("| 100.0%")
             sys.stdout.flush()
-        if Normalize:
-            # Normalize LogLikelihoods
-            NormalizeConst = scipy.special.logsumexp(LogLikelihoods)
-            if np.exp(NormalizeConst) == 0:
-                sys.stdout.write("\nWARNING: All likelihoods are 0.\n")
-            NormLogLikelihoods = LogLikelihoods - NormalizeConst
-        else:
-            # Hacky way because otherwise the subtraction is on different
-            # object types
-            NormalizeConst = scipy.special.logsumexp([0])
-            NormLogLikelihoods = LogLikelihoods - NormalizeConst
-        Results = PosteriorContainer.PosteriorContainer(np.matrix(Costs), np.matrix(
-            Rewards), NormLogLikelihoods, ActionSequence, self.Plr)
+        Results = self.MakeContainer(
+            Costs, Rewards, LogLikelihoods, ActionSequence, Normalize)
+        self.RemoveCheckpoint(Checkpoint)
         if Feedback:
             sys.stdout.write("\n\n")
             Results.Summary()
@@ -298,7 +374,7 @@ class Observer(object):
         """
         self.Plr.Agent.SetRewardSamplingParams(samplingparams)
 
-    def InferAgentUsingPC(self, ActionSequence, PC, Combine=True, Normalize=True, Feedback=False):
+    def InferAgentUsingPC(self, ActionSequence, PC, Combine=True, Normalize=True, Feedback=False, Checkpoint=None, CheckpointEvery=1000, Resume=None):
         """
         Compute the posterior of an action sequence using a set of samples from a PC and their loglikelihoods.
         This let's you take the posterior from one map and use it as a prior for another map, or simply to
@@ -311,6 +387,9 @@ class Observer(object):
                             when false, only the samples are re-used.
             Normalize (bool): Normalize samples?
             Feedback (bool): When true, function gives feedback on percentage complete.
+            Checkpoint (str): (optional) File where progress is saved every CheckpointEvery samples (see ResumeInference()).
+            CheckpointEvery (int): Number of samples between checkpoints.
+            Resume (dict): Checkpoint to continue from. For internal use only; use ResumeInference() instead.
         """
         if not all(isinstance(x, int) for x in ActionSequence):
             if all(isinstance(x, str) for x in ActionSequence):
@@ -320,17 +399,19 @@ class Observer(object):
                     "ERROR: Action sequence must contains the indices of actions or their names.")
                 return None
         Samples = PC.Samples
-        Costs = [0] * Samples
-        Rewards = [0] * Samples
-        LogLikelihoods = [0] * Samples
+        [Start, Costs, Rewards, LogLikelihoods] = self.StartSamples(Samples, Resume)
         # Find what samples we already have.
         RIndices = [PC.ObjectNames.index(
             i) if i in PC.ObjectNames else -1 for i in self.Plr.Map.ObjectNames]
         CIndices = [PC.CostNames.index(
             i) if i in PC.CostNames else -1 for i in self.Plr.Map.StateNames]
+        Arguments = {"ActionSequence": ActionSequence, "PC": PC, "Combine": Combine,
+                     "Normalize": Normalize, "Feedback": Feedback, "CheckpointEvery": CheckpointEvery}
         if Feedback:
             sys.stdout.write("\n")
-        for i in range(Samples):
+        for i in range(Start, Samples):
+            if Checkpoint is not None and i > Start and i % CheckpointEvery == 0:
+                self.SaveCheckpoint(Checkpoint, "InferAgentUsingPC", Arguments, i, Costs, Rewards, LogLikelihoods)
             if Feedback:
                 Percentage = round(i * 100.0 / Samples, 2)
                 sys.stdout.write("\rProgress |")
@@ -377,19 +458,9 @@ class Observer(object):
             sys.stdout.write(self.begincolor + self.block * 20 + self.endcolor)
             sys.stdout.write("| 100.0%")
             sys.stdout.flush()
-        if Normalize:
-            # Normalize LogLikelihoods
-            NormalizeConst = scipy.special.logsumexp(LogLikelihoods)
-            if np.exp(NormalizeConst) == 0:
-                sys.stdout.write("\nWARNING: All likelihoods are 0.\n")
-            NormLogLikelihoods = LogLikelihoods - NormalizeConst
-        else:
-            # Hacky way because otherwise the subtraction is on different
-            # object types
-            NormalizeConst = scipy.special.logsumexp([0])
-            NormLogLikelihoods = LogLikelihoods - NormalizeConst
-        Results = PosteriorContainer.PosteriorContainer(np.matrix(Costs), np.matrix(
-            Rewards), NormLogLikelihoods, ActionSequence, self.Plr)
+        Results = self.MakeContainer(
+            Costs, Rewards, LogLikelihoods, ActionSequence, Normalize)
+        self.RemoveCheckpoint(Checkpoint)
         if Feedback:
             sys.stdout.write("\n\n")
             Results.Summary()
@@ -532,7 +603,7 @@ class Observer(object):
             probs = [str(i) for i in PredictedActions]
             print((",".join(probs)))
 
-    def InferAgent(self, ActionSequence, Samples, Feedback=False, Normalize=True):
+    def InferAgent(self, ActionSequence, Samples, Feedback=False, Normalize=True, Sampling=None, Seed=None, Surrogate=None, Checkpoint=None, CheckpointEvery=1000, TimeBudget=None, Callback=None, CallbackEvery=100, Reducer=None, Retain=None):
         """
         Compute a series of samples with their likelihoods.
 
@@ -542,9 +613,50 @@ class Observer(object):
             Feedback (bool): When true, function gives feedback on percentage complete.
             Normalize (bool): Normalize log-likelihoods? When normalized the LogLikelihoods, integrated
                 over matching samples give you the posterior.
+            Sampling (str): (optional) How to draw from the prior: "Random", "Sobol", or "Halton" (see Agent.SetSampling()).
+                When None the agent's current setting is used. "Exact" enumerates priors with a finite
+                support instead of sampling them (Samples is then ignored; see InferAgent_Enumeration()).
+            Seed (int): (optional) Seed for the quasi-Monte Carlo scrambling.
+            Surrogate (LikelihoodSurrogate): (optional) Surrogate that answers samples in well-explored regions
+                without planning. Set to True to use one with default settings. Call Surrogate.Report() afterwards
+                to see the planner calls saved and the estimated error.
+            Checkpoint (str): (optional) File where completed samples and the random number generators' states are saved
+                every CheckpointEvery samples. If the run is interrupted, ResumeInference(Checkpoint) finishes it
+                and returns the same container an uninterrupted run would have. The file is deleted when the run ends.
+            CheckpointEvery (int): Number of samples between checkpoints.
+            TimeBudget (float): (optional) Number of seconds the inference can run. When time runs out the function
+                returns a container with the samples completed so far (container's Samples attribute;
+                RequestedSamples keeps the original number). At least one sample is always computed.
+            Callback (function): (optional) Function called with an intermediate PosteriorContainer every CallbackEvery samples.
+            CallbackEvery (int): Number of samples between calls to Callback.
+            Reducer (PosteriorReducer): (optional) Summarize the samples as they are produced instead of storing them.
+                The function then returns the reducer, which supports Summary(), GetExpectedCosts(), CompareCosts(), ...
+                with memory that doesn't grow with Samples. Set to True to use one with default settings.
+                Reducers are always normalized.
+            Retain (list): (optional) [TopK, Reservoir]. Shortcut for Reducer=PosteriorReducer(TopK=TopK, Reservoir=Reservoir):
+                keep exact running aggregates, but only retain the TopK most likely samples plus a weighted
+                reservoir sample of Reservoir others.
         """
         ActionSequence = self.GetActionIDs(ActionSequence)
-        return self.InferAgent_ImportanceSampling(ActionSequence, Samples, Normalize, Feedback)
+        if Surrogate is True:
+            Surrogate = LikelihoodSurrogate.LikelihoodSurrogate()
+        if Retain is not None and Reducer is None:
+            Reducer = PosteriorReducer.PosteriorReducer(TopK=Retain[0], Reservoir=Retain[1])
+        if Reducer is True:
+            Reducer = PosteriorReducer.PosteriorReducer()
+        if Sampling == "Exact":
+            return self.InferAgent_Enumeration(ActionSequence, Normalize, Feedback)
+        if Sampling is None:
+            return self.InferAgent_ImportanceSampling(ActionSequence, Samples, Normalize, Feedback, Surrogate, Checkpoint, CheckpointEvery, TimeBudget=TimeBudget, Callback=Callback, CallbackEvery=CallbackEvery, Reducer=Reducer)
+        # Start a fresh sequence for this run and restore the agent afterwards (ResumeInference() does the same).
+        PreviousSampling = self.Plr.Agent.Sampling
+        PreviousSeed = self.Plr.Agent.SamplingSeed
+        self.Plr.Agent.SetSampling(Sampling, Seed)
+        try:
+            return self.InferAgent_ImportanceSampling(ActionSequence, Samples, Normalize, Feedback, Surrogate, Checkpoint, CheckpointEvery, TimeBudget=TimeBudget, Callback=Callback, CallbackEvery=CallbackEvery, Reducer=Reducer,
+                                                      Sampling=[Sampling, Seed, PreviousSampling, PreviousSeed])
+        finally:
+            self.Plr.Agent.SetSampling(PreviousSampling, PreviousSeed)
 
     def GetActionIDs(self, ActionSequence):
         if not all(isinstance(x, int) for x in ActionSequence):
@@ -596,7 +708,7 @@ class Observer(object):
                         str(np.round(self.Plr.Agent.rewards[j], 2)) + "\t")
                 sys.stdout.write(str(ML) + "\n")
 
-    def InferAgent_ImportanceSampling(self, ActionSequence, Samples, Normalize=True, Feedback=False):
+    def InferAgent_ImportanceSampling(self, ActionSequence, Samples, Normalize=True, Feedback=False, Surrogate=None, Checkpoint=None, CheckpointEvery=1000, Resume=None, TimeBudget=None, Callback=None, CallbackEvery=100, Reducer=None, Sampling=None):
         """
         Compute a series of samples with their likelihoods using importance sampling
 
@@ -605,7 +717,18 @@ class Observer(object):
             Samples (int): Number of samples to use
             Normalize (bool): Normalize LogLikelihoods when done?
             Feedback (bool): When true, function gives feedback on percentage complete.
+            Surrogate (LikelihoodSurrogate): (optional) Likelihood surrogate used to skip planning.
+            Checkpoint (str): (optional) File where progress is saved every CheckpointEvery samples (see ResumeInference()).
+            CheckpointEvery (int): Number of samples between checkpoints.
+            Resume (dict): Checkpoint to continue from. For internal use only; use ResumeInference() instead.
+            TimeBudget (float): (optional) Seconds the inference can run before returning the samples completed so far.
+            Callback (function): (optional) Function called with an intermediate PosteriorContainer every CallbackEvery samples.
+            CallbackEvery (int): Number of samples between calls to Callback.
+            Reducer (PosteriorReducer): (optional) Reducer that summarizes the samples instead of storing them.
+            Sampling (list): (optional) [Sampling, Seed, PreviousSampling, PreviousSeed] when InferAgent() changed the agent's
+                sampling for this run. Saved in checkpoints so ResumeInference() restores the agent's previous sampling afterwards.
         """
+        StartTime = time.time()
         if not all(isinstance(x, int) for x in ActionSequence):
             if all(isinstance(x, str) for x in ActionSequence):
                 ActionSequence = self.Plr.Map.GetActionList(ActionSequence)
@@ -613,12 +736,41 @@ class Observer(object):
                 print(
                     "ERROR: Action sequence must contains the indices of actions or their names.")
                 return None
-        Costs = [0] * Samples
-        Rewards = [0] * Samples
-        LogLikelihoods = [0] * Samples
+        if Reducer is None:
+            [Start, Costs, Rewards, LogLikelihoods] = self.StartSamples(Samples, Resume)
+        else:
+            # Samples go straight into the reducer, so only the current one is kept.
+            # When resuming, the checkpoint's copy of the reducer already holds the completed samples.
+            Start = 0 if Resume is None else Resume["Index"]
+            [Costs, Rewards, LogLikelihoods] = [[0], [0], [0]]
+            if Resume is None:
+                Reducer.Reset(ActionSequence, self.Plr)
+        Completed = Samples
+        if Surrogate is not None and Surrogate.ActionSequence != ActionSequence:
+            # Stored likelihoods belong to a different observation
+            Surrogate.Reset(ActionSequence)
+        Arguments = {"ActionSequence": ActionSequence, "Samples": Samples, "Normalize": Normalize,
+                     "Feedback": Feedback, "Surrogate": Surrogate, "CheckpointEvery": CheckpointEvery,
+                     "Reducer": Reducer, "Sampling": Sampling, "TimeBudget": TimeBudget, "CallbackEvery": CallbackEvery}
         if Feedback:
             sys.stdout.write("\n")
-        for i in range(Samples):
+        for i in range(Start, Samples):
+            if Checkpoint is not None and i > Start and i % CheckpointEvery == 0:
+                if TimeBudget is not None:
+                    # A resumed run gets the time that was left
+                    Arguments["TimeBudget"] = max(TimeBudget - (time.time() - StartTime), 0)
+                self.SaveCheckpoint(Checkpoint, "InferAgent_ImportanceSampling",
+                                    Arguments, i, Costs, Rewards, LogLikelihoods)
+            if Callback is not None and i > Start and i % CallbackEvery == 0:
+                if Reducer is not None:
+                    Reducer.Collect()
+                    Callback(Reducer)
+                else:
+                    Callback(self.MakeContainer(
+                        Costs[:i], Rewards[:i], LogLikelihoods[:i], ActionSequence, Normalize, False))
+            if TimeBudget is not None and i > Start and time.time() - StartTime >= TimeBudget:
+                Completed = i
+                break
             if Feedback:
                 Percentage = round(i * 100.0 / Samples, 2)
                 sys.stdout.write("\rProgress |")
@@ -628,38 +780,251 @@ class Observer(object):
                 sys.stdout.write(" " * (20 - roundper))
                 sys.stdout.write("| " + str(Percentage) + "%")
                 sys.stdout.flush()
+            # Position of the sample in the lists (the reducer only needs the current one)
+            j = i if Reducer is None else 0
             # Propose a new sample
             self.Plr.Agent.ResampleAgent()
-            Costs[i] = self.Plr.Agent.costs
-            Rewards[i] = self.Plr.Agent.rewards
+            Costs[j] = self.Plr.Agent.costs
+            Rewards[j] = self.Plr.Agent.rewards
+            Prediction = None
+            if Surrogate is not None:
+                Prediction = Surrogate.Predict(Costs[j], Rewards[j])
+                if Prediction is not None and not Surrogate.Audit():
+                    Surrogate.SurrogateCalls += 1
+                    LogLikelihoods[j] = Prediction
+                    if Reducer is not None:
+                        Reducer.Add(Costs[j], Rewards[j], LogLikelihoods[j])
+                    continue
             # Replan
             self.Plr.Prepare(self.Validate)
             # Get log-likelihood
-            LogLikelihoods[i] = self.Plr.Likelihood(ActionSequence)
+            LogLikelihoods[j] = self.Plr.Likelihood(ActionSequence)
             # If anything went wrong just stop
-            if LogLikelihoods[i] is None:
+            if LogLikelihoods[j] is None:
                 print("ERROR: Failed to compute likelihood. OBSERVER-001")
                 return None
+            if Surrogate is not None:
+                Surrogate.Add(Costs[j], Rewards[j], LogLikelihoods[j], Prediction)
+            if Reducer is not None:
+                Reducer.Add(Costs[j], Rewards[j], LogLikelihoods[j])
         # Finish printing progress bar
+        if Feedback:
+            # Print the final progress bar (incomplete if the time budget ran out)
+            Percentage = round(Completed * 100.0 / Samples, 2)
+            roundper = int(math.floor(Percentage / 5))
+            sys.stdout.write("\rProgress |")
+            sys.stdout.write(self.begincolor + self.block * roundper + self.endcolor)
+            sys.stdout.write(" " * (20 - roundper))
+            sys.stdout.write("| " + str(Percentage) + "%")
+            sys.stdout.flush()
+            if Completed < Samples:
+                sys.stdout.write("\nTime budget ran out after " + str(Completed) +
+                                 " of " + str(Samples) + " samples.")
+            if Surrogate is not None:
+                sys.stdout.write("\n\n")
+                Surrogate.Report()
+        if Reducer is not None:
+            Reducer.Collect()
+            Results = Reducer
+            if Reducer.AllLikelihoodsZero():
+                sys.stdout.write("\nWARNING: All likelihoods are 0.\n")
+        else:
+            Results = self.MakeContainer(Costs[:Completed], Rewards[:Completed],
+                                         LogLikelihoods[:Completed], ActionSequence, Normalize)
+        Results.RequestedSamples = Samples
+        self.RemoveCheckpoint(Checkpoint)
+        if Feedback:
+            sys.stdout.write("\n\n")
+            Results.Summary()
+            sys.stdout.write("\n")
+        return Results
+
+    def MakeContainer(self, Costs, Rewards, LogLikelihoods, ActionSequence, Normalize=True, Warn=True):
+        """
+        Store samples and their log-likelihoods in a PosteriorContainer.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Costs (list): Cost samples
+            Rewards (list): Reward samples
+            LogLikelihoods (list): Log-likelihoods
+            ActionSequence (list): Sequence of actions
+            Normalize (bool): Normalize LogLikelihoods? The container's LogNormalizer keeps the
+                normalizing constant either way.
+            Warn (bool): Print a warning when all likelihoods are 0?
+        """
+        # Keep the normalizing constant so containers can be merged later (see MergeContainers())
+        NormalizeConst = scipy.special.logsumexp(LogLikelihoods)
+        LogLikelihoods = np.asarray(LogLikelihoods, dtype=float)
+        if Normalize:
+            if Warn and np.exp(NormalizeConst) == 0:
+                sys.stdout.write("\nWARNING: All likelihoods are 0.\n")
+            LogLikelihoods = LogLikelihoods - NormalizeConst
+        return PosteriorContainer.PosteriorContainer(
+            Costs, Rewards, LogLikelihoods, ActionSequence, self.Plr,
+            LogNormalizer=NormalizeConst, Normalized=Normalize)
+
+    def StartSamples(self, Samples, Resume=None):
+        """
+        Create the lists where an inference stores its samples, filled with the completed samples of a checkpoint when resuming.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Returns:
+            [Start, Costs, Rewards, LogLikelihoods] where Start is the first sample left to compute.
+        """
+        if Resume is None:
+            return [0, [0] * Samples, [0] * Samples, [0] * Samples]
+        Start = Resume["Index"]
+        Padding = [0] * (Samples - Start)
+        return [Start, Resume["Costs"] + Padding, Resume["Rewards"] + Padding, Resume["LogLikelihoods"] + Padding]
+
+    def SaveCheckpoint(self, Checkpoint, Function, Arguments, Index, Costs, Rewards, LogLikelihoods):
+        """
+        Save an inference's progress so ResumeInference() can finish it.
+        The checkpoint stores the completed samples, the function's arguments, the planner (with the agent and its
+        sampling state), and the states of Python's and numpy's random number generators.
+        The file is replaced atomically, so an interruption while saving keeps the previous checkpoint.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Checkpoint (str): File name
+            Function (str): Name of the Observer method running the inference.
+            Arguments (dict): Arguments to call Function with.
+            Index (int): Number of completed samples.
+            Costs (list): Cost samples
+            Rewards (list): Reward samples
+            LogLikelihoods (list): Log-likelihoods
+        """
+        State = {"Function": Function, "Arguments": Arguments, "Index": Index,
+                 "Costs": Costs[:Index], "Rewards": Rewards[:Index], "LogLikelihoods": LogLikelihoods[:Index],
+                 "Planner": self.Plr, "Validate": self.Validate,
+                 "RandomState": random.getstate(), "NumpyState": np.random.get_state()}
+        with open(Checkpoint + ".tmp", "wb") as CheckpointFile:
+            pickle.dump(State, CheckpointFile)
+        os.replace(Checkpoint + ".tmp", Checkpoint)
+
+    def RemoveCheckpoint(self, Checkpoint):
+        """
+        Delete the checkpoint of a finished inference.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        if Checkpoint is not None and os.path.isfile(Checkpoint):
+            os.remove(Checkpoint)
+
+    def ResumeInference(self, Checkpoint, Feedback=None, Callback=None):
+        """
+        Finish an inference from its checkpoint (see the Checkpoint argument of InferAgent(), InferAgentUsingPC(), and UpdateExperience()).
+
+        The observer's planner and the random number generators are restored to their state when the checkpoint
+        was saved, so the result is identical to the one an uninterrupted run would have produced.
+
+        Args:
+            Checkpoint (str): Checkpoint file
+            Feedback (bool): (optional) Override the original run's feedback setting.
+            Callback (function): (optional) Progress callback of InferAgent() (functions aren't saved in checkpoints).
+                                 The original run's CallbackEvery and remaining TimeBudget are restored from the checkpoint.
+
+        Returns:
+            The result of the original function (a PosteriorContainer, or [PosteriorContainer, Conditioning] for UpdateExperience()).
+        """
+        if not os.path.isfile(Checkpoint):
+            print("ERROR: Checkpoint not found. OBSERVER-003")
+            return None
+        with open(Checkpoint, "rb") as CheckpointFile:
+            State = pickle.load(CheckpointFile)
+        self.Plr = State["Planner"]
+        self.Validate = State["Validate"]
+        random.setstate(State["RandomState"])
+        np.random.set_state(State["NumpyState"])
+        Arguments = dict(State["Arguments"])
+        if Feedback is not None:
+            Arguments["Feedback"] = Feedback
+        if Callback is not None:
+            Arguments["Callback"] = Callback
+        if Arguments.get("Sampling") is None:
+            return getattr(self, State["Function"])(Checkpoint=Checkpoint, Resume=State, **Arguments)
+        # The checkpoint's agent uses the run's sampling; restore the one it had before the run
+        [PreviousSampling, PreviousSeed] = Arguments["Sampling"][2:]
+        try:
+            return getattr(self, State["Function"])(Checkpoint=Checkpoint, Resume=State, **Arguments)
+        finally:
+            self.Plr.Agent.SetSampling(PreviousSampling, PreviousSeed)
+
+    def InferAgent_Enumeration(self, ActionSequence, Normalize=True, Feedback=False):
+        """
+        Compute the posterior by enumerating the full support of the priors.
+        Only works when the cost and reward priors have a finite support (IntegerUniform, Empirical, and Constant).
+        Each cost vector is planned once and each combination is weighted by its prior probability,
+        so the LogLikelihoods in the resulting PosteriorContainer are log-posterior weights.
+
+        Args:
+            ActionSequence (list): Sequence of actions
+            Normalize (bool): Normalize LogLikelihoods when done?
+            Feedback (bool): When true, function gives feedback on percentage complete.
+        """
+        ActionSequence = self.GetActionIDs(ActionSequence)
+        if ActionSequence is None:
+            return None
+        Support = self.Plr.Agent.EnumeratePriors()
+        if Support is None:
+            print("ERROR: Cannot enumerate priors. Use a sampling method instead. OBSERVER-002")
+            return None
+        [CostVectors, CostMasses, RewardVectors, RewardMasses] = Support
+        Samples = len(CostVectors) * len(RewardVectors)
+        if Feedback:
+            sys.stdout.write("\nEnumerating " + str(Samples) + " combinations.\n")
+        Costs = [0] * Samples
+        Rewards = [0] * Samples
+        LogLikelihoods = [0] * Samples
+        i = 0
+        for CostIndex in range(len(CostVectors)):
+            # Costs determine the policies, so plan once per cost vector
+            self.Plr.Agent.costs = CostVectors[CostIndex]
+            self.Plr.BuildPlanner(self.Validate)
+            for RewardIndex in range(len(RewardVectors)):
+                if Feedback:
+                    Percentage = round(i * 100.0 / Samples, 2)
+                    sys.stdout.write("\rProgress |")
+                    roundper = int(math.floor(Percentage / 5))
+                    sys.stdout.write(
+                        self.begincolor + self.block * roundper + self.endcolor)
+                    sys.stdout.write(" " * (20 - roundper))
+                    sys.stdout.write("| " + str(Percentage) + "%")
+                    sys.stdout.flush()
+                self.Plr.Agent.rewards = RewardVectors[RewardIndex]
+                self.Plr.ComputeUtilities()
+                LogLik = self.Plr.Likelihood(ActionSequence)
+                if LogLik is None:
+                    print("ERROR: Failed to compute likelihood. OBSERVER-001")
+                    return None
+                Costs[i] = CostVectors[CostIndex]
+                Rewards[i] = RewardVectors[RewardIndex]
+                # Weight by the prior
+                if LogLik != (-sys.maxsize - 1):
+                    LogLik += np.log(CostMasses[CostIndex] *
+                                     RewardMasses[RewardIndex])
+                LogLikelihoods[i] = LogLik
+                i += 1
         if Feedback:
             # Print complete progress bar
             sys.stdout.write("\rProgress |")
             sys.stdout.write(self.begincolor + self.block * 20 + self.endcolor)
             sys.stdout.write("| 100.0%")
             sys.stdout.flush()
-        if Normalize:
-            # Normalize LogLikelihoods
-            NormalizeConst = scipy.special.logsumexp(LogLikelihoods)
-            if np.exp(NormalizeConst) == 0:
-                sys.stdout.write("\nWARNING: All likelihoods are 0.\n")
-            NormLogLikelihoods = LogLikelihoods - NormalizeConst
-        else:
-            # Hacky way because otherwise the subtraction is on different
-            # object types
-            NormalizeConst = scipy.special.logsumexp([0])
-            NormLogLikelihoods = LogLikelihoods - NormalizeConst
-        Results = PosteriorContainer.PosteriorContainer(np.matrix(Costs), np.matrix(
-            Rewards), NormLogLikelihoods, ActionSequence, self.Plr)
+        Results = self.MakeContainer(
+            Costs, Rewards, LogLikelihoods, ActionSequence, Normalize)
         if Feedback:
             sys.stdout.write("\n\n")
             Results.Summary()
@@ -737,6 +1102,22 @@ class Observer(object):
         Rewards = [0] * Samples
         Actions = [0] * Samples
         States = [0] * Samples
+        if not ResampleAgent:
+            # All agents are the same, so simulate them together.
+            if replan:
+                self.Plr.Prepare(self.Validate)
+            [Actions, States] = self.Plr.SimulateBatch(Samples, Simple)
+            if Verbose:
+                sys.stdout.write("\rProgress |")
+                sys.stdout.write(self.begincolor + self.block * 20 + self.endcolor)
+                sys.stdout.write("| 100.0%")
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+            if HumanReadable:
+                Actions = [self.Plr.Map.GetActionNames(A) for A in Actions]
+            Costs = [self.Plr.Agent.costs] * Samples
+            Rewards = [self.Plr.Agent.rewards] * Samples
+            return AgentSimulation.AgentSimulation(Costs, Rewards, Actions, States, self.Plr.Map.ObjectNames, self.Plr.Map.StateNames)
         for i in range(Samples):
             if Verbose:
                 Percentage = round(i * 100.0 / Samples, 2)
@@ -834,3 +1215,33 @@ class Observer(object):
         else:
             for (property, value) in vars(self).items():
                 print(property)
+
+
+# Observer used by the worker processes of Observer.TestModel().
+TestWorkerObserver = None
+
+
+def InitializeTestWorker(Observer, Cache=False):
+    """
+    Store a copy of the observer in a TestModel worker process and, if requested,
+    enable its plan cache once for all the agents the process tests.
+
+    .. Warning::
+
+       This function is for internal use only.
+    """
+    global TestWorkerObserver
+    TestWorkerObserver = Observer
+    if Cache:
+        TestWorkerObserver.Plr.EnablePlanCache()
+
+
+def RunTestWorker(Task):
+    """
+    Run Observer.TestAgent() in a TestModel worker process.
+
+    .. Warning::
+
+       This function is for internal use only.
+    """
+    return TestWorkerObserver.TestAgent(*Task)
@@ -10,10 +10,8 @@ import copy
 import math
 import random
 import sys
+import time
 import scipy.special
-from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageFont
 import os
 from itertools import product, repeat, permutations
 
@@ -50,6 +48,21 @@ class Planner(object):
         # Internal reward value to plan between goals
         self.planningreward = 500
         self.gamma = 0.95  # Internal future discount to plan between goals
+        # MDP solver used for the sub-MDPs (see MDP.Solve and ChooseSolver()).
+        self.Solver = "ValueIteration"
+        # Candidate paths between critical states (see BuildPathSets()).
+        # None means paths aren't being recorded.
+        self.PathSets = None
+        # Fraction of path-set cost matrices checked against Plan() (see BuildPathSets()).
+        self.PathSetAuditRate = 0.05
+        self.PathSetAudits = 0
+        self.PathSetMismatches = 0
+        self.AuditRNG = random.Random()
+        # Plans (policies and cost matrices) keyed by the agent's costs (see EnablePlanCache()).
+        # None means plans aren't cached.
+        self.PlanCache = None
+        self.PlanCacheSize = 0
+        self.PlanCacheHits = 0
         self.Prepare(Validate)
 
     def Prepare(self, Validate=True):
@@ -91,17 +104,109 @@ class Planner(object):
         # This assumes that the Map object has a dead exit state.
         # Map's Validate checks this.
         self.MDP = MDP(
-            self.Map.S + [max(self.Map.S) + 1], self.Map.A, self.Map.T, self.BuildCostFunction(), self.gamma, self.Agent.actionTau)
+            self.Map.S + [max(self.Map.S) + 1], self.Map.A, self.Map.T, self.BuildCostFunction(), self.gamma, self.Agent.actionTau, self.Map.GetGrid())
         self.CriticalStates = [self.Map.StartingPoint]
         self.CriticalStates.extend(self.Map.ObjectLocations)
         self.CriticalStates.extend([self.Map.ExitState])
         # build the costmatrix and store the policies
-        [Policies, CostMatrix, DistanceMatrix] = self.Plan(Validate)
+        Key = None
+        # Softmaxed actions give different paths (and costs) every time, so those plans are never reused.
+        if self.PlanCache is not None and not self.Agent.SoftmaxAction:
+            Key = (tuple(np.asarray(self.Agent.costs, dtype=float).ravel()), tuple(self.CriticalStates),
+                   self.Agent.actionTau, self.Agent.SoftmaxAction)
+            if Key in self.PlanCache:
+                self.PlanCacheHits += 1
+                [self.Policies, self.CostMatrix,
+                    self.DistanceMatrix] = self.PlanCache[Key]
+                self.Utilities = None
+                self.goalindices = None
+                return None
+        if Key is not None:
+            # Plan with a random stream seeded by the costs. A cached plan is then the same plan that
+            # planning again would give, and neither consumes random numbers from the caller's stream.
+            RandomState = random.getstate()
+            random.seed(hash(Key))
+        try:
+            [Planned, Matrices] = self.PlanOrLookUp(Validate)
+        finally:
+            if Key is not None:
+                random.setstate(RandomState)
+        if Planned is not None:
+            [Policies, CostMatrix, DistanceMatrix] = Planned
+        else:
+            # The path sets give the cost matrix without solving any sub-MDP,
+            # so policies are only solved when something asks for them.
+            [CostMatrix, DistanceMatrix] = Matrices
+            Policies = PolicyCache(self, self.MDP, Validate)
         self.Policies = Policies
         self.CostMatrix = CostMatrix
         self.DistanceMatrix = DistanceMatrix
         self.Utilities = None
         self.goalindices = None
+        if Key is not None:
+            if len(self.PlanCache) >= self.PlanCacheSize:
+                # Forget the oldest plan
+                del self.PlanCache[next(iter(self.PlanCache))]
+            self.PlanCache[Key] = [Policies, CostMatrix, DistanceMatrix]
+
+    def PlanOrLookUp(self, Validate=True):
+        """
+        Get the plans from the path sets when possible, and from Plan() otherwise.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Validate (bool): Check that the objects have all the information to run.
+
+        Returns:
+            [Planned, Matrices] where Planned is Plan()'s output (or None if Plan() didn't run), and Matrices is
+            PathSetCostMatrix()'s output (or None if the path sets weren't used).
+        """
+        Planned = None
+        Matrices = None
+        # With softmaxed actions the path sets give the cost of the most likely path instead of a sampled one.
+        if self.PathSets is not None and not self.Agent.SoftmaxAction:
+            Matrices = self.PathSetCostMatrix()
+            if Matrices is not None and self.AuditRNG.random() < self.PathSetAuditRate:
+                # Check the path sets against Plan(), which also records any path they were missing.
+                Planned = self.Plan(Validate)
+                self.PathSetAudits += 1
+                if not np.allclose(Planned[1], Matrices[0]):
+                    self.PathSetMismatches += 1
+        if Planned is None and Matrices is None:
+            Planned = self.Plan(Validate)
+        return [Planned, Matrices]
+
+    def EnablePlanCache(self, Size=1000):
+        """
+        Reuse plans when the agent's costs repeat.
+
+        Planning only depends on the agent's costs (rewards only enter the utility function), so when a prior
+        produces the same cost vector more than once (e.g., IntegerUniform or Empirical priors) the planner
+        can skip solving the sub-MDPs. Cached plans are keyed by the costs, the critical states, and the action softmax settings.
+        Clear the cache (ClearPlanCache()) if the map's terrain changes.
+
+        While the cache is on, the random choices made while planning (e.g., between equally good actions) are seeded
+        by the costs and don't use the global random stream, so an agent's plans don't depend on which plans are
+        already cached. Plans with softmaxed actions are never cached.
+
+        Args:
+            Size (int): Largest number of plans to keep. The oldest plans are forgotten first.
+                        Each plan holds the policies of every critical state, so large caches use a lot of memory.
+        """
+        if self.PlanCache is None:
+            self.PlanCache = {}
+        self.PlanCacheSize = Size
+
+    def ClearPlanCache(self):
+        """
+        Delete cached plans and stop caching them.
+        """
+        self.PlanCache = None
+        self.PlanCacheSize = 0
+        self.PlanCacheHits = 0
 
     def Plan(self, Validate=True):
         """
@@ -131,23 +236,8 @@ class Planner(object):
         # Now iterate over each combination of critical states.
         # Loop can skip over starting state because agent will never go there.
         for TargetStateIndex in range(1, len(self.CriticalStates)):
-            # Duplicate MDP that you'll manipulate
-            subMDP = copy.deepcopy(self.MDP)
-            # Get target state
-            TargetState = self.CriticalStates[TargetStateIndex]
-            # Reroute target state to dead state
-            # Set to zeros.
-            subMDP.T[TargetState, :, :] = 0
-            # Any action sends to dead state
-            subMDP.T[TargetState, :, len(self.Map.S)] = 1
-            # Add a big reward
-            subMDP.R[:, TargetState] += self.planningreward
-            if Validate:
-                subMDP.Validate()
-            # Calculate and save optimal policy
-            subMDP.ValueIteration()
-            subMDP.BuildPolicy(self.Agent.SoftmaxAction)
-            Policies.append(copy.deepcopy(subMDP.policy))
+            subMDP = self.SolveTarget(TargetStateIndex, Validate)
+            Policies.append(subMDP.policy)
             # Loop over all other critical states and use them as starting
             # points
             PotentialStartingPointIndices = list(range(
@@ -164,16 +254,244 @@ class Planner(object):
                     [self.MDP.R[Actions[i]][StateSequence[i]] for i in range(len(Actions))])
                 CostMatrix[OriginalPointIndex][TargetStateIndex] = TotalCost
                 DistanceMatrix[OriginalPointIndex][TargetStateIndex] = sum([1 if i < 4 else np.sqrt(2) for i in Actions])
+                if self.PathSets is not None:
+                    self.RecordPath(Actions, StateSequence)
         return [Policies, CostMatrix, DistanceMatrix]
 
-    def SimulatePathUntil(self, StartingPoint, StopStates, inputMDP, Limit=300, Simple=False):
+    def SolveTarget(self, TargetStateIndex, Validate=False, BaseMDP=None):
+        """
+        Build and solve the sub-MDP for moving towards one critical state.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            TargetStateIndex (int): Index of the target in CriticalStates.
+            Validate (bool): Validate the sub-MDP?
+            BaseMDP (MDP): MDP to start from. When None the function uses the planner's MDP.
+
+        Returns:
+            subMDP (MDP): Solved MDP with its policy.
+        """
+        if BaseMDP is None:
+            BaseMDP = self.MDP
+        # Reroute target state to dead state (any action sends it there)
+        # and add a big reward. The sub-MDP shares the map's transitions.
+        subMDP = BaseMDP.SubMDP(
+            self.CriticalStates[TargetStateIndex], len(self.Map.S), self.planningreward)
+        if Validate:
+            subMDP.Validate()
+        # Calculate and save optimal policy
+        subMDP.Solve(self.Solver, self.SolverTolerance())
+        subMDP.BuildPolicy(self.Agent.SoftmaxAction)
+        return subMDP
+
+    def SolverTolerance(self):
+        """
+        Convergence parameter for the sub-MDP solvers.
+
+        A target that is n steps away adds gamma**n times its reward to an agent's value, so solvers that stop when values
+        change less than a fixed tolerance never tell agents far from the target where it is. On large maps the tolerance
+        shrinks with the map's width plus height (an estimate of the longest path that includes detours around costly terrain).
+        It never goes below 1e-15, so on maps where goals are more than roughly 600 steps apart the discounted
+        value of a goal is lost to floating point precision and agents far from it may not find it.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        if self.Map.mapwidth <= 0 or self.Map.mapheight <= 0:
+            return 0.0001
+        Horizon = self.Map.mapwidth + self.Map.mapheight
+        Tolerance = min(0.0001, 0.001 * self.planningreward * self.gamma ** Horizon)
+        # Smaller changes are lost to floating point precision
+        return max(Tolerance, 1e-15)
+
+    def ChooseSolver(self, Methods=("ValueIteration", "PolicyIteration", "ModifiedPolicyIteration", "GaussSeidel", "PrioritizedSweeping"), Repeats=3, Silent=False):
+        """
+        Time each MDP solver on the map's sub-MDPs and keep the fastest one.
+
+        All solvers produce the same policies, so this only affects speed.
+        Solvers are timed with the agent's current costs.
+
+        Args:
+            Methods (tuple): Solvers to try (see MDP.Solve).
+            Repeats (int): Number of times each solver solves every sub-MDP.
+            Silent (bool): When False the function prints the timings.
+
+        Returns:
+            Dictionary with the time (in seconds) each solver took.
+        """
+        if self.MDP == []:
+            print("ERROR: Planner has no MDP. Run BuildPlanner() first. PLANNER-004")
+            return None
+        Times = {}
+        for Method in Methods:
+            Start = time.time()
+            for repeat in range(Repeats):
+                # Plan() never solves for the starting state
+                for TargetState in self.CriticalStates[1:]:
+                    subMDP = self.MDP.SubMDP(
+                        TargetState, len(self.Map.S), self.planningreward)
+                    subMDP.Solve(Method, self.SolverTolerance())
+            Times[Method] = time.time() - Start
+            if not Silent:
+                sys.stdout.write(
+                    Method + ": " + str(round(Times[Method], 4)) + " seconds\n")
+        self.Solver = min(Times, key=Times.get)
+        if not Silent:
+            sys.stdout.write("Using " + self.Solver + "\n")
+        return Times
+
+    def BuildPathSets(self, Probes=100, Window=10, AuditRate=0.05, Seed=None):
+        """
+        Collect candidate paths between every pair of critical states by planning with cost samples from the prior.
+
+        For a fixed path, the cost of moving between two critical states is linear in the agent's terrain costs
+        (a vector of terrain counts dotted with the costs), and so is the discounted value the sub-MDP assigns to it.
+        Once the candidate paths are collected, PathSetCostMatrix() computes the CostMatrix for any cost sample
+        (or a whole batch of them) by picking the candidate with the highest value, with no MDP solve at all.
+        While path sets exist, every regular call to Plan() also adds the paths it finds.
+
+        The result matches Plan() exactly when the agent's path for the new costs is in the candidate set,
+        so BuildPlanner() only uses path sets when actions are not softmaxed (with softmaxed actions they would give
+        the cost of the most likely path rather than a sampled one). As a safeguard, BuildPlanner() also runs Plan()
+        on a random fraction (AuditRate) of the cost samples: Plan() records any path the sets were missing, and
+        PathSetMismatches counts the audits where the path sets gave a different CostMatrix.
+        Path sets are keyed by raw state numbers so they survive changes in the starting point,
+        but they must be cleared (ClearPathSets()) if the map's terrain changes.
+
+        Probing the prior is a heuristic: nothing guarantees that every path that is optimal for some cost sample was found.
+        The function reports how many pairs of critical states still gained candidates in the last probes;
+        when that number is zero the set has (empirically) converged, otherwise run more probes.
+
+        Args:
+            Probes (int): Number of cost samples to plan with.
+            Window (int): Number of final probes used to check convergence.
+            AuditRate (float): Probability that BuildPlanner() checks a path-set cost matrix against Plan().
+            Seed (int): Seed for the audit draws (kept separate from the agent's random state).
+
+        Returns:
+            Number of pairs of critical states that gained new candidate paths in the last Window probes.
+        """
+        if self.PathSets is None:
+            self.PathSets = {}
+        self.PathSetAuditRate = AuditRate
+        self.PathSetAudits = 0
+        self.PathSetMismatches = 0
+        self.AuditRNG = random.Random(Seed)
+        OriginalCosts = self.Agent.costs
+        Gained = []
+        for probe in range(Probes + 1):
+            if probe > 0:
+                self.Agent.ResampleCosts()
+            self.MDP = MDP(self.Map.S + [max(self.Map.S) + 1], self.Map.A, self.Map.T,
+                           self.BuildCostFunction(), self.gamma, self.Agent.actionTau, self.Map.GetGrid())
+            Before = {Pair: len(Candidates) for (Pair, Candidates) in self.PathSets.items()}
+            self.Plan(False)
+            Gained.append(set([Pair for (Pair, Candidates) in self.PathSets.items()
+                               if len(Candidates) > Before.get(Pair, 0)]))
+        self.Agent.costs = OriginalCosts
+        self.Prepare(False)
+        NewPairs = len(set().union(*Gained[-Window:])) if Window > 0 else 0
+        if NewPairs > 0:
+            print("WARNING: " + str(NewPairs) + " pairs of critical states gained candidate paths in the last " +
+                  str(min(Window, len(Gained))) + " probes. Path sets may be incomplete; run more probes. PLANNER-015")
+        return NewPairs
+
+    def ClearPathSets(self):
+        """
+        Delete stored candidate paths and stop recording them.
+        """
+        self.PathSets = None
+
+    def RecordPath(self, Actions, StateSequence):
+        """
+        Add a path between two critical states to the path sets.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Actions (list): Actions taken along the path
+            StateSequence (list): States visited (the last one is the target)
+        """
+        Origin = StateSequence[0]
+        Target = StateSequence[-1]
+        if Target not in self.CriticalStates or len(StateSequence) != len(Actions) + 1:
+            # Simulation timed out before reaching the target.
+            return None
+        Counts = np.zeros(self.Agent.CostDimensions)
+        Discounted = np.zeros(self.Agent.CostDimensions)
+        for t in range(len(Actions)):
+            multiplier = 1 if Actions[t] < 4 else np.sqrt(2)
+            Counts[self.Map.StateTypes[StateSequence[t]]] += multiplier
+            Discounted[self.Map.StateTypes[StateSequence[t]]
+                       ] += (self.gamma ** t) * multiplier
+        # Sub-MDPs give the target a big reward minus the cost of standing on it.
+        Discounted[self.Map.StateTypes[Target]] += self.gamma ** len(Actions)
+        Constant = self.planningreward * (self.gamma ** len(Actions))
+        Distance = sum([1 if i < 4 else np.sqrt(2) for i in Actions])
+        Candidates = self.PathSets.setdefault((Origin, Target), {})
+        Candidates[tuple(np.round(np.concatenate((Counts, Discounted)), 10))] = [
+            Counts, Discounted, Constant, Distance]
+
+    def PathSetCostMatrix(self, Costs=None):
+        """
+        Compute the cost and distance matrices from the path sets (see BuildPathSets()).
+
+        Args:
+            Costs (list): A cost vector, or a matrix with one cost sample per row.
+                          When None the function uses the agent's costs.
+
+        Returns:
+            [CostMatrix, DistanceMatrix] for a single cost vector, or arrays where [CostMatrix[n], DistanceMatrix[n]]
+            belong to the nth cost sample. Returns None if some pair of critical states has no candidate paths.
+        """
+        if self.PathSets is None:
+            return None
+        if Costs is None:
+            Costs = self.Agent.costs
+        Costs = np.asarray(Costs, dtype=float)
+        Batch = (Costs.ndim == 2)
+        Costs = np.atleast_2d(Costs)
+        Size = len(self.CriticalStates)
+        CostMatrix = np.zeros((Costs.shape[0], Size, Size))
+        DistanceMatrix = np.zeros((Costs.shape[0], Size, Size))
+        for TargetStateIndex in range(1, Size):
+            PotentialStartingPointIndices = list(range(
+                TargetStateIndex)) + list(range(TargetStateIndex + 1, Size - 1))
+            for OriginalPointIndex in PotentialStartingPointIndices:
+                Candidates = self.PathSets.get(
+                    (self.CriticalStates[OriginalPointIndex], self.CriticalStates[TargetStateIndex]))
+                if not Candidates:
+                    return None
+                Candidates = list(Candidates.values())
+                Counts = np.array([c[0] for c in Candidates])
+                Discounted = np.array([c[1] for c in Candidates])
+                Constants = np.array([c[2] for c in Candidates])
+                Distances = np.array([c[3] for c in Candidates])
+                # Pick the path the sub-MDP values most and report its cost.
+                Best = (Constants - Costs.dot(Discounted.T)).argmax(axis=1)
+                CostMatrix[:, OriginalPointIndex, TargetStateIndex] = - \
+                    (Costs * Counts[Best]).sum(axis=1)
+                DistanceMatrix[:, OriginalPointIndex,
+                               TargetStateIndex] = Distances[Best]
+        if Batch:
+            return [CostMatrix, DistanceMatrix]
+        return [CostMatrix[0], DistanceMatrix[0]]
+
+    def SimulatePathUntil(self, StartingPoint, StopStates, inputMDP, Limit=None, Simple=False):
         """
         .. Warning::
 
            This function is for internal use only.
 
         Simulate path from StartingPoint until agent reaches a state in the StopStates list.
-        Simulation ends after the agent has taken more steps than specified on Limit.
+        Simulation ends after the agent has taken more steps than specified on Limit
+        (by default the number of states in the map, and at least 300).
 
         IMPORTANT: THIS FUNCTION USES LOCAL MDPS AND SUPPORT BUILDING THE UTILITY FUNCTION.
         TO SIMULATE THROUGH THE NAIVE UTILITY CALCULUS USE Planner.Simulate()
@@ -187,6 +505,8 @@ class Planner(object):
                             Note that simple parameter only makes sense when softmax is off.
 
         """
+        if Limit is None:
+            Limit = max(300, len(self.Map.S))
         iterations = 0
         Actions = []
         if not isinstance(StopStates, list):
@@ -216,22 +536,18 @@ class Planner(object):
             C (matrix): Cost function as a matrix where C[A,S] is the cost for tkaing action A in state S.
         """
 
-        Costs = [-self.Agent.costs[self.Map.StateTypes[i]]
-                 for i in range(len(self.Map.S))]
+        Costs = -np.asarray(self.Agent.costs, dtype=float)[self.Map.StateTypes]
 
         if DeadState:
             C = np.zeros((len(self.Map.A), len(self.Map.S) + 1))
-            Costs.append(0)
+            Costs = np.append(Costs, 0)
         else:
             C = np.zeros((len(self.Map.A), len(self.Map.S)))
         # Add regular costs to first four actions.
-        for i in range(4):
-            C[i, :] = Costs
+        C[:4, :] = Costs
         # If agent can travel diagonally then add the diagonal costs.
         if len(self.Map.A) > 4:
-            Costs = [i * np.sqrt(2) for i in Costs]
-            for i in range(4, 8):
-                C[i, :] = Costs
+            C[4:8, :] = Costs * np.sqrt(2)
         return C
 
     def ComputeUtilities(self):
@@ -447,6 +763,110 @@ class Planner(object):
             States.extend(subS[1:])
         return [Actions, States]
 
+    def SimulateBatch(self, Samples, Simple=False, Limit=None):
+        """
+        Simulate many agents with the same costs and rewards at once.
+        Agents choose goals and move as in Simulate(), but all agents advance in lockstep and
+        every step samples their actions and next states with array operations.
+
+        Args:
+            Samples (int): Number of agents to simulate.
+            Simple (bool): When set to true agents select the first highest-value action
+                           (rather than sampling a random one where more than one are equally good).
+                           Only makes sense when softmax is off. Without softmax, goals are always chosen as in Simulate().
+            Limit (int): Largest number of steps an agent can take to reach each sub-goal.
+                         Agents that exceed it stop (see SimulatePathUntil()). By default the number of states in the map, and at least 300.
+
+        Returns:
+            [Actions, States] where Actions[i] and States[i] contain the action and state sequences of the i-th agent.
+        """
+        if self.Utilities is None:
+            print("ERROR: Missing utilities. PLANNER-006")
+            return None
+        if self.goalindices is None:
+            print("ERROR: Missing goal space. PLANNER-007")
+            return None
+        if Limit is None:
+            Limit = max(300, len(self.Map.S))
+        # Choose a goal for each agent.
+        if self.Agent.SoftmaxChoice:
+            Options = np.array(self.Utilities) / self.Agent.choiceTau
+            Probabilities = np.exp(Options - scipy.special.logsumexp(Options))
+            Choices = np.minimum(np.searchsorted(np.cumsum(Probabilities), np.random.rand(
+                Samples), side="right"), len(Options) - 1)
+        else:
+            # Same choice as Simulate(): the first highest-value goal
+            Choices = np.full(Samples, np.argmax(self.Utilities))
+        # Table with the critical state indices each goal visits.
+        PlanLengths = np.array([len(Goal) + 2 for Goal in self.goalindices])
+        PlanTable = np.full((len(self.goalindices), PlanLengths.max()),
+                            len(self.CriticalStates) - 1)
+        for i in range(len(self.goalindices)):
+            PlanTable[i, 1:PlanLengths[i] - 1] = [j + 1 for j in self.goalindices[i]]
+        PlanTable[:, 0] = 0
+        Plans = PlanTable[Choices]
+        PlanLengths = PlanLengths[Choices]
+        # Cumulative policy tables, Cumulative[i, S, A] for moving towards CriticalStates[i]
+        Cumulative = np.zeros((len(self.CriticalStates), len(self.MDP.S), len(self.MDP.A)))
+        for i in range(1, len(self.CriticalStates)):
+            Policy = np.asarray(self.Policies[i]).T
+            if Simple and not self.Agent.SoftmaxAction:
+                Policy = (np.arange(len(self.MDP.A)) ==
+                          Policy.argmax(axis=1)[:, np.newaxis]).astype(float)
+            Cumulative[i] = np.cumsum(Policy, axis=1)
+        [Next, Prob] = self.MDP.SuccessorTable()
+        CumulativeProb = np.cumsum(Prob, axis=2)
+        CriticalStates = np.array(self.CriticalStates)
+        # Simulate
+        State = np.full(Samples, self.CriticalStates[0])
+        Stage = np.ones(Samples, dtype=int)
+        StageSteps = np.zeros(Samples, dtype=int)
+        Active = np.ones(Samples, dtype=bool)
+        Lengths = np.zeros(Samples, dtype=int)
+        ActionLog = np.zeros((Samples, 64), dtype=int)
+        StateLog = np.zeros((Samples, 65), dtype=int)
+        StateLog[:, 0] = State
+        while True:
+            # Move agents that reached their sub-goal to the next one
+            while True:
+                Reached = Active & (
+                    State == CriticalStates[Plans[np.arange(Samples), np.minimum(Stage, PlanLengths - 1)]])
+                if not Reached.any():
+                    break
+                Stage[Reached] += 1
+                StageSteps[Reached] = 0
+                Active[Reached & (Stage >= PlanLengths)] = False
+            Agents = np.nonzero(Active)[0]
+            if len(Agents) == 0:
+                break
+            Targets = Plans[Agents, Stage[Agents]]
+            Current = State[Agents]
+            Choice = (Cumulative[Targets, Current] <=
+                      np.random.rand(len(Agents))[:, np.newaxis]).sum(axis=1)
+            Choice = np.minimum(Choice, len(self.MDP.A) - 1)
+            if Next.shape[2] == 1:
+                NewState = Next[Current, Choice, 0]
+            else:
+                Outcome = (CumulativeProb[Current, Choice] <=
+                           np.random.rand(len(Agents))[:, np.newaxis]).sum(axis=1)
+                NewState = Next[Current, Choice, np.minimum(Outcome, Next.shape[2] - 1)]
+            if Lengths.max() + 1 >= ActionLog.shape[1]:
+                ActionLog = np.concatenate((ActionLog, np.zeros(ActionLog.shape, dtype=int)), axis=1)
+                StateLog = np.concatenate((StateLog, np.zeros(StateLog.shape, dtype=int)), axis=1)
+            ActionLog[Agents, Lengths[Agents]] = Choice
+            Lengths[Agents] += 1
+            StateLog[Agents, Lengths[Agents]] = NewState
+            State[Agents] = NewState
+            StageSteps[Agents] += 1
+            Stuck = StageSteps > Limit
+            if Stuck.any():
+                print("ERROR: Simulation exceeded timelimit. PLANNER-009")
+                Active[Stuck] = False
+                StageSteps[Stuck] = 0
+        Actions = [ActionLog[i, :Lengths[i]].tolist() for i in range(Samples)]
+        States = [StateLog[i, :Lengths[i] + 1].tolist() for i in range(Samples)]
+        return [Actions, States]
+
     def Likelihood(self, ActionSequence):
         """
         Calculate the loglikelihood of a sequence of actions
@@ -638,6 +1058,9 @@ class Planner(object):
         objectcolors = ["#FF5005", "#FFFF00", "#FFFF80", "#990000",
                         "#740AFF", "#00998F", "#426600", "#003380", "#C20088", "#94FFB5",
                         "#2BCE48", "#5EF1F2"]
+        from PIL import Image
+        from PIL import ImageDraw
+        from PIL import ImageFont
         if not self.Map.Validate():
             print(
                 "WARNING: Map is not well formed. May fail to render image. PLANNER-013")
@@ -684,3 +1107,38 @@ class Planner(object):
                                (DY + 1) * size], str(actionid), "#000000", fontsmall)
         # Save image
         im.save(filename)
+
+
+class PolicyCache(object):
+
+    """
+    List-like store of the planner's policies that solves each sub-MDP the first time its policy is requested.
+    PolicyCache[i] contains the policy for moving to CriticalStates[i] (PolicyCache[0] is empty, as in Planner.Plan()).
+    """
+
+    def __init__(self, Planner, BaseMDP, Validate=False):
+        """
+        Create an empty policy cache.
+
+        Args:
+            Planner (Planner): Planner that owns the policies.
+            BaseMDP (MDP): MDP with the agent's costs when the cache was created.
+            Validate (bool): Validate sub-MDPs when they are built?
+        """
+        self.Planner = Planner
+        self.BaseMDP = BaseMDP
+        self.Validate = Validate
+        self.Policies = [[]] + [None] * (len(Planner.CriticalStates) - 1)
+        # Number of sub-MDPs solved so far
+        self.Solved = 0
+
+    def __getitem__(self, index):
+        if self.Policies[index] is None:
+            subMDP = self.Planner.SolveTarget(index, self.Validate, self.BaseMDP)
+            self.Policies[index] = subMDP.policy
+            self.Solved += 1
+        return self.Policies[index]
+
+    def __len__(self):
+        return len(self.Policies)
+
@@ -6,10 +6,10 @@ Comes with a bunch of supporting methods to analyze the samples.
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
+import scipy.special
 import sys
 import os.path
-import math
+import copy
 
 
 class PosteriorContainer(object):
@@ -19,23 +19,43 @@ class PosteriorContainer(object):
     Comes with a bunch of supporting methods to analyze the samples.
     """
 
-    def __init__(self, C, R, L, ActionSequence, Planner=[]):
+    # Number of samples processed at a time by methods that go through all samples
+    BlockSize = 262144
+
+    def __init__(self, C, R, L, ActionSequence, Planner=[], SinglePrecision=False, LogNormalizer=0.0, Normalized=False):
         """
         Create an object that stores inputs to generative model.
 
+        Samples are stored column by column in a single array (Data), with the costs first and the rewards after them.
+        Columns maps each cost and object name to its column.
+
         Args:
             C (list): List of cost samples
             R (list): List of reward samples
             L (list): List of log-likelihoods
             ActionSequence (list): List of actions
             Planner (Planner): (optional) Planner object (The generative model)
+            SinglePrecision (bool): Store the samples as float32 (log-likelihoods are always stored as float64).
+            LogNormalizer (float): Log of the sum of the likelihoods before normalization.
+            Normalized (bool): Was LogNormalizer subtracted from L? Containers keep their LogNormalizer
+                               so their samples can be merged and renormalized (see MergeContainers()).
         """
-        self.CostSamples = C
-        self.RewardSamples = R
-        self.LogLikelihoods = L
-        self.CostDimensions = self.CostSamples.shape[1]
-        self.RewardDimensions = self.RewardSamples.shape[1]
-        self.Samples = self.RewardSamples.shape[0]
+        C = np.asarray(C, dtype=float)
+        R = np.asarray(R, dtype=float)
+        self.CostDimensions = C.shape[1]
+        self.RewardDimensions = R.shape[1]
+        self.Samples = R.shape[0]
+        self.Data = np.empty((self.Samples, self.CostDimensions + self.RewardDimensions),
+                             dtype=np.float32 if SinglePrecision else np.float64, order='F')
+        self.Data[:, :self.CostDimensions] = C
+        self.Data[:, self.CostDimensions:] = R
+        self.LogLikelihoods = np.asarray(L, dtype=np.float64).ravel()
+        self.LogNormalizer = float(LogNormalizer)
+        self.Normalized = Normalized
+        # Marginals and sorted samples computed by Marginal() and WeightedQuantiles()
+        self.MarginalCache = {}
+        # Number of samples the inference was asked for (larger than Samples when a time budget ran out).
+        self.RequestedSamples = self.Samples
         self.Actions = ActionSequence
         self.MapFile = None
         # Extract information from the planner object
@@ -65,6 +85,252 @@ class PosteriorContainer(object):
             self.actionTau = None
             self.choiceTau = None
             self.Method = "Unknown"
+        self.BuildColumns()
+
+    @property
+    def CostSamples(self):
+        """
+        Cost samples (one row per sample). A view into Data.
+        """
+        return self.Data[:, :self.CostDimensions]
+
+    @CostSamples.setter
+    def CostSamples(self, Value):
+        self.Data[:, :self.CostDimensions] = np.asarray(Value)
+        self.MarginalCache = {}
+
+    @property
+    def RewardSamples(self):
+        """
+        Reward samples (one row per sample). A view into Data.
+        """
+        return self.Data[:, self.CostDimensions:]
+
+    @RewardSamples.setter
+    def RewardSamples(self, Value):
+        self.Data[:, self.CostDimensions:] = np.asarray(Value)
+        self.MarginalCache = {}
+
+    def __setstate__(self, State):
+        """
+        Restore a pickled container. Containers saved before the samples were stored in Data
+        kept them as CostSamples and RewardSamples matrices; these are moved into Data.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        if "Data" not in State:
+            C = np.asarray(State.pop("CostSamples"), dtype=np.float64)
+            R = np.asarray(State.pop("RewardSamples"), dtype=np.float64)
+            State["Data"] = np.asfortranarray(np.hstack((C, R)))
+            State["LogLikelihoods"] = np.asarray(State["LogLikelihoods"], dtype=np.float64).ravel()
+            State.setdefault("RequestedSamples", State["Samples"])
+        if "LogNormalizer" not in State:
+            # The normalizing constant wasn't saved, so treat the log-likelihoods as unnormalized.
+            State["LogNormalizer"] = 0.0
+            State["Normalized"] = False
+        State.setdefault("MarginalCache", {})
+        self.__dict__.update(State)
+        if "Columns" not in State:
+            self.BuildColumns()
+
+    def BuildColumns(self):
+        """
+        Map cost and object names to their column in Data.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        CostNames = self.CostNames if self.CostNames is not None else [
+            "Terrain" + str(i) for i in range(self.CostDimensions)]
+        ObjectNames = self.ObjectNames if self.ObjectNames is not None else [
+            "Object" + str(i) for i in range(self.RewardDimensions)]
+        self.Columns = {}
+        for i in range(self.CostDimensions):
+            self.Columns[str(CostNames[i])] = i
+        for i in range(self.RewardDimensions):
+            self.Columns.setdefault(str(ObjectNames[i]), self.CostDimensions + i)
+
+    def Column(self, Name):
+        """
+        Get the samples of a cost or a reward by name.
+
+        Args:
+            Name (str): Terrain or object name (or TerrainN/ObjectN when the map has no names).
+
+        Returns:
+            Samples (ndarray): View into Data, or None if the name doesn't exist.
+        """
+        if Name not in self.Columns:
+            print("ERROR: No cost or reward named " + str(Name) + ". POSTERIORCONTAINER-003")
+            return None
+        return self.Data[:, self.Columns[Name]]
+
+    def UsefulSamples(self):
+        """
+        Count the samples with a non-zero likelihood.
+        """
+        return int(np.count_nonzero(self.LogLikelihoods != (- sys.maxsize - 1)))
+
+    def AllLikelihoodsZero(self):
+        """
+        Check if every sample has likelihood zero (normalizing them leaves all log-likelihoods at zero).
+        """
+        return not np.any(self.LogLikelihoods)
+
+    def UnnormalizedLogLikelihoods(self):
+        """
+        Get the log-likelihoods before normalization.
+
+        Returns:
+            LogLikelihoods (ndarray)
+        """
+        if self.Normalized:
+            return self.LogLikelihoods + self.LogNormalizer
+        return np.asarray(self.LogLikelihoods)
+
+    def Resample(self, Size=None, Method="Systematic", Seed=None):
+        """
+        Resample the container into an equally weighted one, so follow-up computations (e.g., Observer.InferAgentUsingPC(),
+        PredictPlan(), and PredictAction()) only run on samples that carry posterior mass.
+
+        Args:
+            Size (int): Number of samples in the new container. When None it keeps the current number of samples.
+            Method (str): "Systematic" (one uniform draw shared by evenly spaced positions), "Stratified" (one uniform
+                          draw per position), or "Residual" (each sample is copied floor(Size * weight) times and
+                          the remaining positions are drawn at random from the leftover weights).
+            Seed (int): (optional) Seed for the draws. When None numpy's global random state is used.
+
+        Returns:
+            PosteriorContainer with Size samples (in their original order), each with log-likelihood -log(Size).
+            Its LogNormalizer is the original evidence, so resampled containers can still be merged (see MergeContainers()).
+        """
+        if Size is None:
+            Size = self.Samples
+        if self.Samples == 0 or self.UsefulSamples() == 0:
+            print("ERROR: All likelihoods are zero. Cannot resample. POSTERIORCONTAINER-006")
+            return None
+        Generator = np.random if Seed is None else np.random.RandomState(Seed)
+        Weights = np.exp(self.LogLikelihoods - scipy.special.logsumexp(self.LogLikelihoods))
+        Cumulative = np.cumsum(Weights)
+        Cumulative /= Cumulative[-1]
+        if Method == "Systematic":
+            Indices = np.searchsorted(Cumulative, (Generator.rand() + np.arange(Size)) / Size, side="right")
+        elif Method == "Stratified":
+            Indices = np.searchsorted(Cumulative, (Generator.rand(Size) + np.arange(Size)) / Size, side="right")
+        elif Method == "Residual":
+            Copies = np.floor(Size * Weights).astype(int)
+            Remaining = Size - Copies.sum()
+            Indices = np.repeat(np.arange(self.Samples), Copies)
+            if Remaining > 0:
+                Leftover = Size * Weights - Copies
+                Indices = np.sort(np.concatenate(
+                    (Indices, Generator.choice(self.Samples, Remaining, p=Leftover / Leftover.sum()))))
+        else:
+            print("ERROR: Resampling method not found. Use Systematic, Stratified, or Residual. POSTERIORCONTAINER-004")
+            return None
+        Indices = np.minimum(Indices, self.Samples - 1)
+        Result = self.Subset(Indices, np.full(Size, -np.log(Size)))
+        # The new log-likelihoods are normalized even if the original ones weren't
+        Result.LogNormalizer = float(scipy.special.logsumexp(self.UnnormalizedLogLikelihoods()))
+        Result.Normalized = True
+        return Result
+
+    def Compact(self, RemoveZero=True):
+        """
+        Merge identical samples into one sample whose likelihood is the sum of theirs.
+
+        Args:
+            RemoveZero (bool): Also remove samples with likelihood zero (unless every sample has likelihood zero).
+
+        Returns:
+            PosteriorContainer with one sample per distinct sample, in order of first appearance.
+        """
+        [Unique, First, Groups] = np.unique(np.asarray(self.Data), axis=0, return_index=True, return_inverse=True)
+        Groups = Groups.ravel()
+        # Sum the likelihoods of each group in log space
+        Largest = np.full(len(First), -np.inf)
+        np.maximum.at(Largest, Groups, self.LogLikelihoods)
+        Sums = np.bincount(Groups, weights=np.exp(self.LogLikelihoods - Largest[Groups]), minlength=len(First))
+        LogLikelihoods = Largest + np.log(Sums)
+        Order = np.argsort(First, kind="stable")
+        if RemoveZero:
+            Useful = LogLikelihoods[Order] != (- sys.maxsize - 1)
+            if np.any(Useful):
+                Order = Order[Useful]
+        return self.Subset(First[Order], LogLikelihoods[Order])
+
+    def Subset(self, Indices, LogLikelihoods):
+        """
+        Create a copy of the container with a subset of its samples and new log-likelihoods.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        Result = copy.copy(self)
+        Result.Data = np.asfortranarray(self.Data[Indices])
+        Result.LogLikelihoods = np.asarray(LogLikelihoods, dtype=np.float64)
+        Result.Samples = len(Indices)
+        Result.RequestedSamples = Result.Samples
+        Result.MarginalCache = {}
+        return Result
+
+    def SetPrecision(self, SinglePrecision=True):
+        """
+        Change how the samples are stored.
+
+        Args:
+            SinglePrecision (bool): When true the samples are stored as float32 (half the memory), otherwise as float64.
+        """
+        self.Data = np.asfortranarray(self.Data, dtype=np.float32 if SinglePrecision else np.float64)
+        self.MarginalCache = {}
+
+    def Weights(self, limit=None):
+        """
+        Get the likelihood of the first N samples.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            limit (int): Index of the last sample to use. If set to None, function uses all samples.
+
+        Returns:
+            Weights (ndarray): Normalized likelihoods (uniform if all likelihoods are zero).
+        """
+        if limit is None:
+            limit = self.Samples - 1
+        NL = np.exp(self.LogLikelihoods[0:(limit + 1)])
+        Total = NL.sum()
+        if Total == 0:
+            print("WARNING: All likelihoods are zero up to this point. POSTERIORCONTAINER-001")
+            return np.full(NL.shape[0], 1.0 / NL.shape[0])
+        return NL / Total
+
+    def Comparison(self, Samples):
+        """
+        Create a matrix where (i,j) is the probability that column i is higher than or equal to column j.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Samples (ndarray): Samples (one column per dimension)
+        """
+        NL = np.exp(self.LogLikelihoods)
+        Dimensions = Samples.shape[1]
+        GreaterEqual = np.zeros((Dimensions, Dimensions))
+        for Start in range(0, self.Samples, self.BlockSize):
+            Block = np.asarray(Samples[Start:(Start + self.BlockSize)])
+            for i in range(Dimensions):
+                GreaterEqual[i] += NL[Start:(Start + self.BlockSize)].dot(Block[:, [i]] >= Block)
+        # (i, j) with i <= j holds p(X(i) >= X(j)) and (j, i) holds p(X(i) < X(j)), as in the pairwise loop.
+        return np.triu(GreaterEqual) + np.tril(NL.sum() - GreaterEqual.T, -1)
 
     def SaveCSV(self, filename, overwrite=False):
         """
@@ -99,17 +365,12 @@ class PosteriorContainer(object):
                     Header = Header + ",Terrain" + str(i)
             Header = Header + ",LogLikelihood\n"
             f.write(Header)
-            # Now add the samples
-            for i in range(self.CostSamples.shape[0]):
-                for j in range(self.RewardDimensions):
-                    if j == 0:
-                        NewLine = str(self.RewardSamples[i, j])
-                    else:
-                        NewLine = NewLine + "," + str(self.RewardSamples[i, j])
-                for j in range(self.CostDimensions):
-                    NewLine = NewLine + "," + str(self.CostSamples[i, j])
-                NewLine = NewLine + "," + str(self.LogLikelihoods[i]) + "\n"
-                f.write(NewLine)
+            # Now add the samples, a block at a time so mapped samples aren't all read at once
+            for Start in range(0, self.Samples, self.BlockSize):
+                Block = np.column_stack((self.RewardSamples[Start:(Start + self.BlockSize)],
+                                         self.CostSamples[Start:(Start + self.BlockSize)],
+                                         self.LogLikelihoods[Start:(Start + self.BlockSize)]))
+                f.write("".join([",".join(map(repr, Row)) + "\n" for Row in Block.tolist()]))
             f.close()
 
     def AssociateMap(self, MapName):
@@ -138,33 +399,14 @@ class PosteriorContainer(object):
         Create a matrix where (i,j) is the probability that object i has a
         higher or equal reward than object j.
         """
-        RewardComparison = np.zeros(
-            (self.RewardDimensions, self.RewardDimensions))
-        for i in range(self.RewardDimensions):
-            for j in range(i, self.RewardDimensions):
-                for s in range(self.Samples):
-                    if (self.RewardSamples[s, i] >= self.RewardSamples[s, j]):
-                        RewardComparison[i][
-                            j] += np.exp(self.LogLikelihoods[s])
-                    else:
-                        RewardComparison[j][
-                            i] += np.exp(self.LogLikelihoods[s])
-        return RewardComparison
+        return self.Comparison(self.RewardSamples)
 
     def CompareCosts(self):
         """
         Create a matrix where (i,j) is the probability that terrain i has a
         higher or equal cost than terrain j.
         """
-        CostComparison = np.zeros((self.CostDimensions, self.CostDimensions))
-        for i in range(self.CostDimensions):
-            for j in range(i, self.CostDimensions):
-                for s in range(self.Samples):
-                    if (self.CostSamples[s, i] >= self.CostSamples[s, j]):
-                        CostComparison[i][j] += np.exp(self.LogLikelihoods[s])
-                    else:
-                        CostComparison[j][i] += np.exp(self.LogLikelihoods[s])
-        return CostComparison
+        return self.Comparison(self.CostSamples)
 
     def GetExpectedCosts(self, limit=None):
         """
@@ -173,21 +415,9 @@ class PosteriorContainer(object):
         Args:
             limit (int): Number of samples to use. If set to None, function uses all samples.
         """
-        ExpectedCosts = []
         if limit is None:
             limit = self.Samples - 1
-        for i in range(self.CostDimensions):
-            NL = np.exp(self.LogLikelihoods[0:(limit + 1)])
-            if sum(NL) == 0:
-                print("WARNING: All likelihoods are zero up to this point. POSTERIORCONTAINER-001")
-                NL = [1.0 / NL.shape[0]]
-            else:
-                NL = NL / sum(NL)
-            a = self.CostSamples[0:(limit + 1), i]
-            b = NL
-            res = sum([float(a[i]) * float(b[i]) for i in range(limit + 1)])
-            ExpectedCosts.append(res)
-        return ExpectedCosts
+        return self.Weights(limit).dot(self.CostSamples[0:(limit + 1)]).tolist()
 
     def GetExpectedRewards(self, limit=None):
         """
@@ -196,82 +426,243 @@ class PosteriorContainer(object):
         Args:
             limit (int): Number of samples to use. If set to None, function uses all samples.
         """
-        ExpectedRewards = []
         if limit is None:
             limit = self.Samples - 1
-        for i in range(self.RewardDimensions):
-            NL = np.exp(self.LogLikelihoods[0:(limit + 1)])
-            if sum(NL) == 0:
-                print("WARNING: All likelihoods are zero up to this point. POSTERIORCONTAINER-001")
-                NL = [1.0 / NL.shape[0]]
-            else:
-                NL = NL / sum(NL)
-            a = self.RewardSamples[0:(limit + 1), i]
-            b = NL
-            res = sum([float(a[i]) * float(b[i]) for i in range(limit + 1)])
-            ExpectedRewards.append(res)
-        return ExpectedRewards
+        return self.Weights(limit).dot(self.RewardSamples[0:(limit + 1)]).tolist()
 
-    def PlotCostPosterior(self, bins=None):
+    def Marginal(self, Name, Bins=20, Method="Histogram", Points=200):
         """
-        Plot posterior distribution of cost samples.
+        Compute the posterior marginal of a cost or a reward. Results are cached on the container.
 
         Args:
-            bins (int): Number of bins to use
+            Name (str): Terrain or object name (or TerrainN/ObjectN when the map has no names).
+            Bins (int): Number of bins of a histogram. Bins span from 0 (or the smallest sample, if it's negative) to the largest sample.
+            Method (str): "Histogram" (likelihood-weighted histogram) or "KDE" (likelihood-weighted
+                          Gaussian kernel density estimate with Silverman's bandwidth).
+            Points (int): Number of grid points of a kernel density estimate.
+
+        Returns:
+            [Edges, Probabilities] for histograms (Edges has one more entry) or [Grid, Density] for kernel density estimates.
+        """
+        Key = (Name, Method, Bins if Method == "Histogram" else Points)
+        if Key in self.MarginalCache:
+            return self.MarginalCache[Key]
+        Values = self.Column(Name)
+        if Values is None:
+            return None
+        Values = np.asarray(Values, dtype=np.float64)
+        Weights = self.Weights()
+        if Method == "Histogram":
+            Lower = min(0, Values.min())
+            Upper = Values.max() if Values.max() > Lower else Lower + 1
+            [Probabilities, Edges] = np.histogram(Values, Bins, range=(Lower, Upper), weights=Weights)
+            Result = [Edges, Probabilities]
+        elif Method == "KDE":
+            Result = self.KernelDensity(Values, Weights, Points)
+        else:
+            print("ERROR: Marginal method not found. Use Histogram or KDE. POSTERIORCONTAINER-005")
+            return None
+        self.MarginalCache[Key] = Result
+        return Result
+
+    def KernelDensity(self, Values, Weights, Points):
+        """
+        Weighted Gaussian kernel density estimate on a grid. Samples are spread linearly over the two nearest
+        grid points and the result is convolved with the kernel, so the cost grows with Points, not with the number of samples.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Returns:
+            [Grid, Density]
+        """
+        Mean = Weights.dot(Values)
+        Spread = np.sqrt(Weights.dot((Values - Mean) ** 2))
+        Bandwidth = 1.06 * Spread * (1.0 / (Weights ** 2).sum()) ** -0.2
+        if Bandwidth == 0:
+            # All the mass is on one value
+            Bandwidth = 1e-3 * max(abs(Mean), 1)
+        Grid = np.linspace(Values.min() - 3 * Bandwidth, Values.max() + 3 * Bandwidth, Points)
+        Step = Grid[1] - Grid[0]
+        Position = (Values - Grid[0]) / Step
+        Left = np.clip(np.floor(Position).astype(int), 0, Points - 2)
+        Fraction = Position - Left
+        Mass = (np.bincount(Left, weights=Weights * (1 - Fraction), minlength=Points) +
+                np.bincount(Left + 1, weights=Weights * Fraction, minlength=Points))
+        Offsets = np.arange(-(Points - 1), Points) * Step
+        Kernel = np.exp(-0.5 * (Offsets / Bandwidth) ** 2)
+        Density = np.convolve(Mass, Kernel, mode="valid")
+        return [Grid, Density / (Density.sum() * Step)]
+
+    def WeightedQuantiles(self, Name, Quantiles):
+        """
+        Compute posterior quantiles of a cost or a reward. The sorted samples are cached on the container.
+
+        Args:
+            Name (str): Terrain or object name.
+            Quantiles (list): Quantiles between 0 and 1.
+
+        Returns:
+            Values (ndarray), one per quantile.
+        """
+        Key = ("Sorted", Name)
+        if Key not in self.MarginalCache:
+            Values = self.Column(Name)
+            if Values is None:
+                return None
+            Order = np.argsort(Values, kind="stable")
+            Cumulative = np.cumsum(self.Weights()[Order])
+            self.MarginalCache[Key] = [np.asarray(Values)[Order], Cumulative / Cumulative[-1]]
+        [Sorted, Cumulative] = self.MarginalCache[Key]
+        Indices = np.minimum(np.searchsorted(Cumulative, Quantiles, side="left"), len(Sorted) - 1)
+        return Sorted[Indices]
+
+    def CredibleInterval(self, Name, Mass=0.95):
+        """
+        Compute the central credible interval of a cost or a reward.
+
+        Args:
+            Name (str): Terrain or object name.
+            Mass (float): Posterior probability inside the interval.
+
+        Returns:
+            [Lower, Upper]
+        """
+        Tail = (1 - Mass) / 2.0
+        Bounds = self.WeightedQuantiles(Name, [Tail, 1 - Tail])
+        if Bounds is None:
+            return None
+        return Bounds.tolist()
+
+    def ColumnNames(self):
+        """
+        Get the names of the costs and the rewards, in the order they are stored.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        return sorted(self.Columns, key=self.Columns.get)
+
+    def ExportMarginals(self, Filename=None, Bins=20, Method="Histogram", Mass=0.95):
+        """
+        Compute the marginal and the credible interval of every cost and reward.
+
+        Args:
+            Filename (str): (optional) When provided the arrays are also saved in a numpy .npz file
+                            (as Name_X, Name_Y, and Name_CredibleInterval).
+            Bins (int): Number of histogram bins (see Marginal()).
+            Method (str): "Histogram" or "KDE" (see Marginal()).
+            Mass (float): Probability mass of the credible intervals.
+
+        Returns:
+            Dictionary from names to {"X": bin edges or grid, "Y": probabilities or densities, "CredibleInterval": [Lower, Upper]}.
+        """
+        Results = {}
+        Arrays = {}
+        for Name in self.ColumnNames():
+            [X, Y] = self.Marginal(Name, Bins, Method)
+            Results[Name] = {"X": X, "Y": Y, "CredibleInterval": self.CredibleInterval(Name, Mass)}
+            Arrays[Name + "_X"] = X
+            Arrays[Name + "_Y"] = Y
+            Arrays[Name + "_CredibleInterval"] = np.array(Results[Name]["CredibleInterval"])
+        if Filename is not None:
+            np.savez(Filename, **Arrays)
+        return Results
+
+    def NewFigure(self, Filename, Panels=1):
+        """
+        Create a figure. Figures saved to a file are drawn on matplotlib's Agg canvas,
+        so they don't need pyplot, an interactive backend, or a display.
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Returns:
+            [Figure, Axes]
+        """
+        if Filename is None:
+            import matplotlib.pyplot as plt
+            return list(plt.subplots(1, Panels))
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        NewFigure = Figure()
+        FigureCanvasAgg(NewFigure)
+        return [NewFigure, NewFigure.subplots(1, Panels)]
+
+    def ShowFigure(self, Figure, Filename):
+        """
+        Show a figure, or save it when a filename is provided.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        if Filename is None:
+            import matplotlib.pyplot as plt
+            plt.show()
+        else:
+            Figure.savefig(Filename)
+
+    def PlotMarginals(self, Names, Legend, bins, Method, Label, Title, Filename):
+        """
+        Plot the marginals of a set of costs or rewards.
+
+        .. Warning::
+
+           This function is for internal use only.
         """
         if bins is None:
             print("Number of bins not specified. Defaulting to 10.")
             bins = 10
-        maxval = np.amax(self.CostSamples)
-        binwidth = maxval * 1.0 / bins + 0.00001
-        xvals = [binwidth * (i + 0.5) for i in range(bins)]
-        for i in range(self.CostDimensions):
-            yvals = [0] * bins
-            insert_indices = [int(math.floor(j / binwidth))
-                              for j in self.CostSamples[:, i]]
-            for j in range(self.Samples):
-                yvals[insert_indices[j]] += np.exp(self.LogLikelihoods[j])
-            plt.plot(xvals, yvals)
-        if self.CostNames is not None:
-            plt.legend(self.CostNames, loc='upper left')
+        [Figure, Axes] = self.NewFigure(Filename)
+        for Name in Names:
+            [X, Y] = self.Marginal(Name, bins, Method)
+            if Method == "Histogram":
+                # Plot each bin at its center
+                X = (X[:-1] + X[1:]) / 2
+            Axes.plot(X, Y)
+        if Legend is not None:
+            Axes.legend(Legend, loc='upper left')
         else:
-            plt.legend([str(i)
-                        for i in range(self.CostDimensions)], loc='upper left')
-        plt.xlabel("Cost")
-        plt.ylabel("Probability")
-        plt.title("Posterior distribution of terrain costs")
-        plt.show()
+            Axes.legend([str(i) for i in range(len(Names))], loc='upper left')
+        Axes.set_xlabel(Label)
+        Axes.set_ylabel("Probability" if Method == "Histogram" else "Density")
+        Axes.set_title(Title)
+        self.ShowFigure(Figure, Filename)
+        return Figure
 
-    def PlotRewardPosterior(self, bins=None):
+    def PlotCostPosterior(self, bins=None, Method="Histogram", Filename=None):
+        """
+        Plot posterior distribution of cost samples.
+
+        Args:
+            bins (int): Number of bins to use
+            Method (str): "Histogram" or "KDE" (see Marginal())
+            Filename (str): (optional) Save the plot to this file (e.g., a .png) instead of showing it.
+
+        Returns:
+            matplotlib Figure
+        """
+        return self.PlotMarginals(self.ColumnNames()[:self.CostDimensions], self.CostNames, bins, Method,
+                                  "Cost", "Posterior distribution of terrain costs", Filename)
+
+    def PlotRewardPosterior(self, bins=None, Method="Histogram", Filename=None):
         """
         Plot posterior distribution of reward samples.
 
         Args:
             bins (int): Number of bins to use
+            Method (str): "Histogram" or "KDE" (see Marginal())
+            Filename (str): (optional) Save the plot to this file (e.g., a .png) instead of showing it.
+
+        Returns:
+            matplotlib Figure
         """
-        if bins is None:
-            print("Number of bins not specified. Defaulting to 10.")
-            bins = 10
-        maxval = np.amax(self.RewardSamples)
-        binwidth = maxval * 1.0 / bins + 0.00001
-        xvals = [binwidth * (i + 0.5) for i in range(bins)]
-        for i in range(self.RewardDimensions):
-            yvals = [0] * bins
-            insert_indices = [int(math.floor(j / binwidth))
-                              for j in self.RewardSamples[:, i]]
-            for j in range(self.Samples):
-                yvals[insert_indices[j]] += np.exp(self.LogLikelihoods[j])
-            plt.plot(xvals, yvals)
-        if self.ObjectNames is not None:
-            plt.legend(self.ObjectNames, loc='upper left')
-        else:
-            plt.legend([str(i)
-                        for i in range(self.RewardDimensions)], loc='upper left')
-            plt.set
-        plt.xlabel("Reward")
-        plt.ylabel("Probability")
-        plt.title("Posterior distribution of rewards")
-        plt.show()
+        return self.PlotMarginals(self.ColumnNames()[self.CostDimensions:], self.ObjectNames, bins, Method,
+                                  "Reward", "Posterior distribution of rewards", Filename)
 
     def Summary(self, human=True, Id=None):
         """
@@ -287,7 +678,7 @@ class PosteriorContainer(object):
         ExpectedCosts = self.GetExpectedCosts()
         CostMatrix = self.CompareCosts()
         # Combine all functions to print summary
-        if not np.any(self.LogLikelihoods):
+        if self.AllLikelihoodsZero():
             sys.stdout.write(
                 "All samples have likelihood 0. Ensure the observed path is rational or raise the choice and/or action softmax parameters")
             return None
@@ -319,8 +710,7 @@ class PosteriorContainer(object):
                 sys.stdout.write("Softmaxed actions.\n")
             else:
                 sys.stdout.write("Optimal actions.\n")
-            usefulsamples = len(
-                [i for i in self.LogLikelihoods if i != (- sys.maxsize - 1)])
+            usefulsamples = self.UsefulSamples()
             sys.stdout.write("\nNumber of useful samples: " +
                              str(usefulsamples) + "(" + str(usefulsamples * 100.0 / self.Samples) + "%)\n")
             sys.stdout.write("\n Maximum likelihood result\n\n")
@@ -408,8 +798,7 @@ class PosteriorContainer(object):
             # Print general info
             if Id is not None:
                 sys.stdout.write(str(Id) + ",")
-            usefulsamples = len(
-                [i for i in self.LogLikelihoods if i != (- sys.maxsize - 1)])
+            usefulsamples = self.UsefulSamples()
             sys.stdout.write(
                 str(self.Samples) + "," + str(usefulsamples) + "," + str(self.StartingPoint) + ",")
             # print object locations
@@ -449,52 +838,68 @@ class PosteriorContainer(object):
             # First two parameters don't matter because human is set to false.
             [C, R] = self.ML(1, 2, False)
             for i in range(self.RewardDimensions):
-                sys.stdout.write("," + str(R[0, i]))
+                sys.stdout.write("," + str(R[i]))
             for i in range(self.CostDimensions):
-                sys.stdout.write("," + str(C[0, i]))
+                sys.stdout.write("," + str(C[i]))
             # Print reward tradeoffs
-            RewardM = self.CompareRewards()
+            RewardM = RewardMatrix
             for i in range(self.RewardDimensions):
                 for j in range(i + 1, self.RewardDimensions):
                     if i != j:
                         sys.stdout.write("," + str(RewardM[i][j]))
             # Print cost tradeoffs
-            CostM = self.CompareCosts()
+            CostM = CostMatrix
             for i in range(self.CostDimensions):
                 for j in range(i + 1, self.CostDimensions):
                     if i != j:
                         sys.stdout.write("," + str(CostM[i][j]))
             sys.stdout.write("\n")
 
-    def AnalyzeConvergence(self, jump=None):
+    def AnalyzeConvergence(self, jump=None, Plot=True, Filename=None):
         """
         Plot estimates as a function of the number of samples to visually determine is samples converged.
 
+        Estimates are computed in a single pass with cumulative log-sum-exps, so they don't underflow.
+        Shaded bands show one Monte Carlo standard error and the last panel shows the effective sample size.
+
         Args:
-            jump (int): Number of skips between each sample.
+            jump (int): Number of skips between each sample. When None, about 1000 points are used.
+            Plot (bool): When false the function returns the estimates instead of plotting them.
+            Filename (str): (optional) Save the plot to this file instead of showing it.
+
+        Returns:
+            When Plot is false, a dictionary with the number of samples used at each point ("Samples"),
+            the expected costs and rewards ("Costs" and "Rewards", one row per point), their Monte Carlo
+            standard errors ("CostErrors" and "RewardErrors"), and the effective sample size ("ESS").
         """
-        NL = np.exp(self.LogLikelihoods)
-        if sum(NL) == 0:
+        if self.Samples == 0 or self.AllLikelihoodsZero() or self.UsefulSamples() == 0:
             print("ERROR: All likelihoods are zero up to this point. Cannot analyze convergence POSTERIORCONTAINER-002")
             return None
-        # jump indicates how often to recompute the expected value
         if jump is None:
-            if self.Samples > 100:
-                print("Recomputing expected value after every 20 samples")
-                jump = int(round(self.Samples * 1.0 / 20))
-            else:
-                print("Recomputing expected value after every sample")
-                jump = 1
-        rangevals = list(range(0, self.Samples, jump))
-        ycostvals = [self.GetExpectedCosts(i) for i in rangevals]
-        ycostvals = np.array(ycostvals)
-        yrewardvals = [self.GetExpectedRewards(i) for i in rangevals]
-        yrewardvals = np.array(yrewardvals)
+            jump = max(1, int(round(self.Samples / 1000.0)))
+        Points = np.arange(0, self.Samples, jump)
+        LogLikelihoods = np.asarray(self.LogLikelihoods, dtype=np.float64)
+        # log of the running sums of weights and of squared weights
+        LogWeightSums = np.logaddexp.accumulate(LogLikelihoods)[Points]
+        LogSquareSums = np.logaddexp.accumulate(2 * LogLikelihoods)[Points]
+        [Costs, CostErrors] = self.RunningEstimates(self.CostSamples, LogLikelihoods, Points, LogWeightSums)
+        [Rewards, RewardErrors] = self.RunningEstimates(self.RewardSamples, LogLikelihoods, Points, LogWeightSums)
+        # Estimates are undefined until the first sample with a non-zero likelihood
+        Undefined = np.cumsum(LogLikelihoods != (- sys.maxsize - 1))[Points] == 0
+        for Estimates in [Costs, CostErrors, Rewards, RewardErrors]:
+            Estimates[Undefined] = np.nan
+        Results = {"Samples": Points + 1, "Costs": Costs, "Rewards": Rewards,
+                   "CostErrors": CostErrors, "RewardErrors": RewardErrors,
+                   "ESS": np.exp(2 * LogWeightSums - LogSquareSums)}
+        if not Plot:
+            return Results
         # break it into plots.
+        [f, axarr] = self.NewFigure(Filename, 3)
         # Costs
-        f, axarr = plt.subplots(1, 2)
         for i in range(self.CostDimensions):
-            axarr[0].plot(rangevals, ycostvals[:, i])
+            axarr[0].plot(Results["Samples"], Costs[:, i])
+            axarr[0].fill_between(Results["Samples"], Costs[:, i] - CostErrors[:, i],
+                                  Costs[:, i] + CostErrors[:, i], alpha=0.2)
         if self.CostNames is not None:
             axarr[0].legend(self.CostNames, loc='upper left')
         else:
@@ -502,13 +907,71 @@ class PosteriorContainer(object):
                 [str(i) for i in range(self.CostDimensions)], loc='upper left')
         # Rewards
         for i in range(self.RewardDimensions):
-            axarr[1].plot(rangevals, yrewardvals[:, i])
+            axarr[1].plot(Results["Samples"], Rewards[:, i])
+            axarr[1].fill_between(Results["Samples"], Rewards[:, i] - RewardErrors[:, i],
+                                  Rewards[:, i] + RewardErrors[:, i], alpha=0.2)
         if self.ObjectNames is not None:
             axarr[1].legend(self.ObjectNames, loc='upper left')
         else:
             axarr[1].legend(
                 [str(i) for i in range(self.RewardDimensions)], loc='upper left')
-        plt.show()
+        # Effective sample size
+        axarr[2].plot(Results["Samples"], Results["ESS"])
+        axarr[2].set_title("Effective sample size")
+        self.ShowFigure(f, Filename)
+
+    def RunningEstimates(self, Samples, LogLikelihoods, Points, LogWeightSums):
+        """
+        Compute the weighted mean of each column over the first samples, and its Monte Carlo standard error,
+        at every point in one pass.
+
+        Sums are accumulated in log space, splitting positive and negative values. The standard error of a
+        self-normalized importance sampling estimate is sqrt(sum(w^2 (x - mean)^2)) / sum(w).
+
+        .. Warning::
+
+           This function is for internal use only.
+
+        Args:
+            Samples (ndarray): Samples (one column per dimension)
+            LogLikelihoods (ndarray): Log-likelihoods of the samples
+            Points (ndarray): Indices of the last sample used by each estimate
+            LogWeightSums (ndarray): Running log-sum-exp of the log-likelihoods at each point
+
+        Returns:
+            [Means, Errors] (one row per point)
+        """
+        Means = np.zeros((len(Points), Samples.shape[1]))
+        Errors = np.zeros((len(Points), Samples.shape[1]))
+        Ones = np.ones(len(LogLikelihoods))
+        # Running sum of squared weights, relative to the squared running sum of weights
+        SquareWeights = self.RunningSum(2 * LogLikelihoods, Ones, Points, 2 * LogWeightSums)
+        with np.errstate(divide="ignore"):
+            for i in range(Samples.shape[1]):
+                Values = np.asarray(Samples[:, i], dtype=np.float64)
+                LogValues = np.log(np.abs(Values))
+                Signs = np.sign(Values)
+                Mean = self.RunningSum(LogLikelihoods + LogValues, Signs, Points, LogWeightSums)
+                # sum(w^2 x) and sum(w^2 x^2)
+                SquareWeighted = self.RunningSum(2 * LogLikelihoods + LogValues, Signs, Points, 2 * LogWeightSums)
+                SquareWeightedSquares = self.RunningSum(
+                    2 * LogLikelihoods + 2 * LogValues, Signs ** 2, Points, 2 * LogWeightSums)
+                Variance = SquareWeightedSquares - 2 * Mean * SquareWeighted + Mean ** 2 * SquareWeights
+                Means[:, i] = Mean
+                Errors[:, i] = np.sqrt(np.maximum(Variance, 0))
+        return [Means, Errors]
+
+    def RunningSum(self, LogTerms, Signs, Points, LogScale):
+        """
+        Compute running sums of Signs * exp(LogTerms) divided by exp(LogScale) at each point, without leaving log space until the end.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        Plus = np.logaddexp.accumulate(np.where(Signs > 0, LogTerms, -np.inf))[Points]
+        Minus = np.logaddexp.accumulate(np.where(Signs < 0, LogTerms, -np.inf))[Points]
+        return np.exp(Plus - LogScale) - np.exp(Minus - LogScale)
 
     def ML(self, n=1, roundparam=2, human=True):
         """
@@ -518,7 +981,10 @@ class PosteriorContainer(object):
         roundparam (int): How much to round the samples
         human (bool): When set to true prints nicely, when set to false returns format for csv structure (in this case n is set to 1 and values aren't rounded)
         """
-        indices = self.LogLikelihoods.argsort()[-n:]
+        # Most likely sample first
+        n = min(n, len(self.LogLikelihoods))
+        indices = np.argpartition(-self.LogLikelihoods, n - 1)[:n]
+        indices = indices[np.argsort(-self.LogLikelihoods[indices], kind="stable")]
         likelihoods = np.exp(self.LogLikelihoods[indices])
         Costs = self.CostSamples[indices]
         Rewards = self.RewardSamples[indices]
@@ -550,7 +1016,7 @@ class PosteriorContainer(object):
                 sys.stdout.write(
                     str(np.round(likelihoods[top], roundparam)) + "\n")
         else:
-            return [Costs[0], Rewards[0]]
+            return [Costs[0].tolist(), Rewards[0].tolist()]
 
     def Display(self, Full=False):
         """
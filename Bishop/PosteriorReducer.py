@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+
+"""
+PosteriorReducer summarizes samples as they are produced instead of storing them.
+Observer.InferAgent uses it when only posterior means, comparison matrices, and histograms are needed.
+"""
+
+import numpy as np
+import scipy.special
+import heapq
+import random
+import sys
+from . import PosteriorContainer
+
+
+class PosteriorReducer(PosteriorContainer.PosteriorContainer):
+
+    """
+    PosteriorReducer keeps running likelihood-weighted aggregates of the samples, so its memory doesn't grow with the number of samples.
+    It answers the same questions as a PosteriorContainer (Summary(), GetExpectedCosts(), CompareCosts(), ...) using the aggregates,
+    which are exact. Only a bounded set of samples is retained: the TopK most likely ones and a weighted reservoir sample of the rest.
+    """
+
+    def __init__(self, Bins=20, TopK=1, Reservoir=0, Seed=None):
+        """
+        Create a reducer. Observer.InferAgent() prepares it for the observed actions (see Reset()).
+
+        Args:
+            Bins (int): Number of histogram bins for each cost and reward (rounded up to an even number).
+                        Histograms start over [0, 1) and double their range, upwards or downwards,
+                        when a value outside it arrives.
+            TopK (int): Number of most likely samples to retain (at least 1, so ML() works).
+            Reservoir (int): Number of other samples to retain, chosen by priority sampling (each sample's
+                             priority is its likelihood divided by a uniform draw). Retained samples are
+                             weighted so estimates from them are unbiased (see Collect()).
+            Seed (int): Seed for the reservoir draws (kept separate from the agent's random state).
+        """
+        self.Bins = Bins + Bins % 2
+        self.TopK = max(TopK, 1)
+        self.Reservoir = Reservoir
+        self.RNG = random.Random(Seed)
+        self.Ready = False
+
+    def Reset(self, ActionSequence, Planner):
+        """
+        Forget all samples and prepare the reducer for an inference.
+
+        Args:
+            ActionSequence (list): List of actions
+            Planner (Planner): Planner object (The generative model)
+        """
+        PosteriorContainer.PosteriorContainer.__init__(
+            self, np.zeros((0, Planner.Agent.CostDimensions)), np.zeros((0, Planner.Agent.RewardDimensions)),
+            [], ActionSequence, Planner, LogNormalizer=-np.inf, Normalized=True)
+        Dimensions = self.CostDimensions + self.RewardDimensions
+        # Aggregates are weighted by exp(LogLikelihood - MaxLogLikelihood) so they never overflow.
+        self.MaxLogLikelihood = -np.inf
+        self.WeightSum = 0.0
+        self.Sums = np.zeros(Dimensions)
+        self.SquareSums = np.zeros(Dimensions)
+        self.CostGreaterEqual = np.zeros((self.CostDimensions, self.CostDimensions))
+        self.RewardGreaterEqual = np.zeros((self.RewardDimensions, self.RewardDimensions))
+        self.Histograms = np.zeros((Dimensions, self.Bins))
+        self.HistogramBottoms = np.zeros(Dimensions)
+        self.HistogramTops = np.ones(Dimensions)
+        # Columns where a likely sample (infinite or NaN) couldn't be placed in the histogram
+        self.HistogramClipped = np.zeros(Dimensions, dtype=bool)
+        self.Useful = 0
+        # Min-heaps of (LogLikelihood, Index, Sample) and (log priority, Index, LogLikelihood, Sample).
+        # The reservoir holds one extra sample whose priority is the inclusion threshold.
+        self.TopSamples = []
+        self.ReservoirSamples = []
+        self.LogWeights = np.zeros(0)
+        self.Ready = True
+
+    def Add(self, costs, rewards, LogLikelihood):
+        """
+        Add a sample.
+
+        Args:
+            costs (list): Cost sample
+            rewards (list): Reward sample
+            LogLikelihood (float): Log-likelihood of the sample
+        """
+        self.AddBatch([costs], [rewards], [LogLikelihood])
+
+    def AddBatch(self, Costs, Rewards, LogLikelihoods):
+        """
+        Add a set of samples.
+
+        Args:
+            Costs (list): Cost samples (one row per sample)
+            Rewards (list): Reward samples (one row per sample)
+            LogLikelihoods (list): Log-likelihoods
+        """
+        if not self.Ready:
+            print("ERROR: Reducer isn't prepared for an inference. Call Reset() first. POSTERIORREDUCER-001")
+            return None
+        Costs = np.asarray(Costs, dtype=float).reshape(-1, self.CostDimensions)
+        Rewards = np.asarray(Rewards, dtype=float).reshape(-1, self.RewardDimensions)
+        LogLikelihoods = np.asarray(LogLikelihoods, dtype=float).ravel()
+        Samples = np.hstack((Costs, Rewards))
+        Best = int(np.argmax(LogLikelihoods))
+        if LogLikelihoods[Best] > self.MaxLogLikelihood:
+            # Rescale the aggregates to the new maximum
+            Scale = np.exp(self.MaxLogLikelihood - LogLikelihoods[Best])
+            self.MaxLogLikelihood = LogLikelihoods[Best]
+            self.WeightSum *= Scale
+            self.Sums *= Scale
+            self.SquareSums *= Scale
+            self.CostGreaterEqual *= Scale
+            self.RewardGreaterEqual *= Scale
+            self.Histograms *= Scale
+        for i in range(LogLikelihoods.shape[0]):
+            self.Retain(Samples[i], LogLikelihoods[i], self.Samples + i)
+        Weights = np.exp(LogLikelihoods - self.MaxLogLikelihood)
+        self.WeightSum += Weights.sum()
+        self.Sums += Weights.dot(Samples)
+        self.SquareSums += Weights.dot(Samples ** 2)
+        for i in range(self.CostDimensions):
+            self.CostGreaterEqual[i] += Weights.dot(Costs[:, [i]] >= Costs)
+        for i in range(self.RewardDimensions):
+            self.RewardGreaterEqual[i] += Weights.dot(Rewards[:, [i]] >= Rewards)
+        self.AddToHistograms(Samples, Weights)
+        self.Samples += LogLikelihoods.shape[0]
+        self.RequestedSamples = self.Samples
+        self.Useful += int(np.count_nonzero(LogLikelihoods != (- sys.maxsize - 1)))
+        self.LogNormalizer = float(self.MaxLogLikelihood + np.log(self.WeightSum))
+
+    def Retain(self, Sample, LogLikelihood, Index):
+        """
+        Offer a sample to the top-K set. Samples that don't make it (or that it pushes out) are offered to the reservoir.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        Entry = (LogLikelihood, Index, Sample)
+        if len(self.TopSamples) < self.TopK:
+            heapq.heappush(self.TopSamples, Entry)
+            return None
+        if Entry > self.TopSamples[0]:
+            Entry = heapq.heapreplace(self.TopSamples, Entry)
+        if self.Reservoir > 0:
+            (LogLikelihood, Index, Sample) = Entry
+            Priority = LogLikelihood - np.log(1 - self.RNG.random())
+            Entry = (Priority, Index, LogLikelihood, Sample)
+            if len(self.ReservoirSamples) <= self.Reservoir:
+                heapq.heappush(self.ReservoirSamples, Entry)
+            elif Entry > self.ReservoirSamples[0]:
+                heapq.heapreplace(self.ReservoirSamples, Entry)
+
+    def Collect(self):
+        """
+        Store the retained samples in Data, most likely samples first, followed by the reservoir.
+
+        LogLikelihoods holds their normalized log-likelihoods (so ML() and SaveCSV() work on them).
+        LogWeights holds their normalized log-weights for estimates from the retained samples alone:
+        top-K samples keep their likelihood and reservoir samples get max(likelihood, threshold),
+        where the threshold is the priority of the reservoir's extra sample (priority sampling).
+        """
+        Top = sorted(self.TopSamples, reverse=True)
+        Reservoir = sorted(self.ReservoirSamples, reverse=True)
+        Threshold = -np.inf
+        if len(Reservoir) > self.Reservoir:
+            Threshold = Reservoir.pop()[0]
+        Rows = [Entry[2] for Entry in Top] + [Entry[3] for Entry in Reservoir]
+        LogLikelihoods = np.array([Entry[0] for Entry in Top] + [Entry[2] for Entry in Reservoir])
+        LogWeights = np.array([Entry[0] for Entry in Top] + [max(Entry[2], Threshold) for Entry in Reservoir])
+        if len(Rows) > 0:
+            self.Data = np.asfortranarray(Rows, dtype=self.Data.dtype)
+            self.LogLikelihoods = LogLikelihoods - self.LogNormalizer
+            self.LogWeights = LogWeights - scipy.special.logsumexp(LogWeights)
+
+    def ToContainer(self):
+        """
+        Create a PosteriorContainer with the retained samples (see Collect()).
+        Their log-likelihoods are the retained samples' normalized log-weights, so the container's estimates
+        match the reducer's estimates from the retained samples. The histograms, heaps, and other aggregates are dropped.
+
+        Returns:
+            PosteriorContainer
+        """
+        self.Collect()
+        Result = PosteriorContainer.PosteriorContainer(
+            np.zeros((0, self.CostDimensions)), np.zeros((0, self.RewardDimensions)), [], self.Actions, None)
+        for Attribute in vars(Result):
+            if Attribute not in ["Data", "LogLikelihoods", "MarginalCache"]:
+                setattr(Result, Attribute, getattr(self, Attribute))
+        Result.Data = np.asfortranarray(self.Data.copy())
+        Result.LogLikelihoods = np.array(self.LogWeights)
+        Result.Samples = Result.Data.shape[0]
+        Result.RequestedSamples = Result.Samples
+        return Result
+
+    def RetainedSamples(self):
+        """
+        Number of samples retained in Data (after Collect()).
+        """
+        return self.Data.shape[0]
+
+    def AddToHistograms(self, Samples, Weights):
+        """
+        Add weighted samples to the histograms. A histogram whose samples don't fit doubles its range
+        (merging its bins in pairs) towards the side they fall on, so its range always includes 0.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        for i in range(Samples.shape[1]):
+            Values = Samples[:, i]
+            Finite = Values[np.isfinite(Values)]
+            if np.any(Weights[~np.isfinite(Values)] > 0):
+                self.HistogramClipped[i] = True
+            Top = Finite.max(initial=0)
+            Bottom = Finite.min(initial=0)
+            while Top >= self.HistogramTops[i]:
+                Merged = self.Histograms[i, 0::2] + self.Histograms[i, 1::2]
+                self.Histograms[i] = np.concatenate((Merged, np.zeros(self.Bins // 2)))
+                self.HistogramTops[i] += self.HistogramTops[i] - self.HistogramBottoms[i]
+            while Bottom < self.HistogramBottoms[i]:
+                Merged = self.Histograms[i, 0::2] + self.Histograms[i, 1::2]
+                self.Histograms[i] = np.concatenate((np.zeros(self.Bins // 2), Merged))
+                self.HistogramBottoms[i] -= self.HistogramTops[i] - self.HistogramBottoms[i]
+            Width = self.HistogramTops[i] - self.HistogramBottoms[i]
+            Indices = np.clip(np.nan_to_num((Values - self.HistogramBottoms[i]) * self.Bins / Width),
+                              0, self.Bins - 1).astype(int)
+            self.Histograms[i] += np.bincount(Indices, weights=Weights, minlength=self.Bins)
+
+    def GetHistogram(self, Name):
+        """
+        Get the posterior histogram of a cost or a reward.
+
+        Args:
+            Name (str): Terrain or object name (or TerrainN/ObjectN when the map has no names).
+
+        Returns:
+            [Edges, Probabilities] (Edges has one more entry than Probabilities), or None if the name doesn't exist.
+        """
+        if Name not in self.Columns:
+            print("ERROR: No cost or reward named " + str(Name) + ". POSTERIORREDUCER-005")
+            return None
+        Column = self.Columns[Name]
+        Edges = np.linspace(self.HistogramBottoms[Column], self.HistogramTops[Column], self.Bins + 1)
+        return [Edges, self.Histograms[Column] / self.WeightSum]
+
+    def Marginal(self, Name, Bins=None, Method="Histogram", Points=None):
+        """
+        Get the posterior marginal of a cost or a reward from the reducer's histograms.
+
+        Args:
+            Name (str): Terrain or object name.
+            Bins (int): Not used (the reducer's bins are fixed when it's created).
+            Method (str): Only "Histogram" is available.
+            Points (int): Not used.
+
+        Returns:
+            [Edges, Probabilities]
+        """
+        if Method != "Histogram":
+            print("ERROR: Reducers only keep histograms. POSTERIORREDUCER-003")
+            return None
+        return self.GetHistogram(Name)
+
+    def WeightedQuantiles(self, Name, Quantiles):
+        """
+        Compute posterior quantiles of a cost or a reward, interpolating within the histogram's bins.
+
+        Args:
+            Name (str): Terrain or object name.
+            Quantiles (list): Quantiles between 0 and 1.
+
+        Returns:
+            Values (ndarray), one per quantile, or None if the histogram had to clip samples.
+        """
+        Histogram = self.GetHistogram(Name)
+        if Histogram is None:
+            return None
+        if self.HistogramClipped[self.Columns[Name]]:
+            print("ERROR: Histogram of " + str(Name) + " clipped samples that aren't finite. Quantiles would be wrong. POSTERIORREDUCER-004")
+            return None
+        [Edges, Probabilities] = Histogram
+        Cumulative = np.concatenate(([0], np.cumsum(Probabilities)))
+        return np.interp(Quantiles, Cumulative, Edges)
+
+    def GetExpectedCosts(self, limit=None):
+        """
+        Calculate the expected costs.
+
+        Args:
+            limit (int): Not supported (reducers don't keep the order of the samples).
+        """
+        return (self.Sums[:self.CostDimensions] / self.WeightSum).tolist()
+
+    def GetExpectedRewards(self, limit=None):
+        """
+        Calculate the expected rewards.
+
+        Args:
+            limit (int): Not supported (reducers don't keep the order of the samples).
+        """
+        return (self.Sums[self.CostDimensions:] / self.WeightSum).tolist()
+
+    def GetCostVariances(self):
+        """
+        Calculate the posterior variance of each cost.
+        """
+        Means = self.Sums[:self.CostDimensions] / self.WeightSum
+        return np.maximum(self.SquareSums[:self.CostDimensions] / self.WeightSum - Means ** 2, 0).tolist()
+
+    def GetRewardVariances(self):
+        """
+        Calculate the posterior variance of each reward.
+        """
+        Means = self.Sums[self.CostDimensions:] / self.WeightSum
+        return np.maximum(self.SquareSums[self.CostDimensions:] / self.WeightSum - Means ** 2, 0).tolist()
+
+    def CompareRewards(self):
+        """
+        Create a matrix where (i,j) is the probability that object i has a
+        higher or equal reward than object j.
+        """
+        return self.Comparison(self.RewardGreaterEqual)
+
+    def CompareCosts(self):
+        """
+        Create a matrix where (i,j) is the probability that terrain i has a
+        higher or equal cost than terrain j.
+        """
+        return self.Comparison(self.CostGreaterEqual)
+
+    def Comparison(self, GreaterEqual):
+        """
+        Turn the running sums of weights where column i >= column j into a comparison matrix.
+
+        .. Warning::
+
+           This function is for internal use only.
+        """
+        GreaterEqual = GreaterEqual / self.WeightSum
+        return np.triu(GreaterEqual) + np.tril(1 - GreaterEqual.T, -1)
+
+    def UsefulSamples(self):
+        """
+        Count the samples with a non-zero likelihood.
+        """
+        return self.Useful
+
+    def AllLikelihoodsZero(self):
+        """
+        Check if every sample has likelihood zero.
+        """
+        return self.Useful == 0
+
+    def UnnormalizedLogLikelihoods(self):
+        """
+        Not available: reducers don't keep every sample.
+        """
+        print("ERROR: Reducers don't keep every sample. POSTERIORREDUCER-002")
+        return None
+
+    def ML(self, n=1, roundparam=2, human=True):
+        """
+        Print maximum likelihood sample(s) (see PosteriorContainer.ML()). Only retained samples are considered,
+        so n should be at most TopK.
+        """
+        self.Collect()
+        return PosteriorContainer.PosteriorContainer.ML(self, n, roundparam, human)
+
+    def SaveCSV(self, filename, overwrite=False):
+        """
+        Export the retained samples as a .csv file (see PosteriorContainer.SaveCSV()).
+        """
+        self.Collect()
+        PosteriorContainer.PosteriorContainer.SaveCSV(self, filename, overwrite)
+
+    def Resample(self, Size=None, Method="Systematic", Seed=None):
+        """
+        Not available: reducers don't keep every sample.
+        """
+        print("ERROR: Reducers don't keep every sample. POSTERIORREDUCER-002")
+        return None
+
+    def Compact(self, RemoveZero=True):
+        """
+        Not available: reducers don't keep every sample.
+        """
+        print("ERROR: Reducers don't keep every sample. POSTERIORREDUCER-002")
+        return None
+
+    def AnalyzeConvergence(self, jump=None, Plot=True, Filename=None):
+        """
+        Not available: reducers don't keep the order of the samples.
+        """
+        print("ERROR: Reducers don't keep every sample. POSTERIORREDUCER-002")
@@ -4,5 +4,7 @@ from .Map import *
 from .Planner import *
 from .Observer import *
 from .AuxiliaryFunctions import *
+from .PosteriorReducer import *
 from .PosteriorContainer import *
 from .AgentSimulation import *
+from .LikelihoodSurrogate import *
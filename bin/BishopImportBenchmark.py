@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+"""
+Script to measure how long "import Bishop" takes in a fresh interpreter.
+
+For help:
+>> python BishopImportBenchmark.py --help
+
+Example:
+
+>> python BishopImportBenchmark.py --repeats 10
+
+imports Bishop in 10 new python processes and reports the median time.
+
+>> python BishopImportBenchmark.py --limit 0.5
+
+fails (exit status 1) if the median import time is above 0.5 seconds, or if importing
+Bishop loads a dependency that should only be loaded when it's used (matplotlib, PIL, scipy.stats, pkg_resources).
+"""
+
+__author__ = "Julian Jara-Ettinger"
+__license__ = "MIT"
+
+import sys
+import json
+import argparse
+import subprocess
+
+# Modules that Bishop only needs for plotting, drawing maps, quasi-random sampling, or reports.
+LazyModules = ["matplotlib", "PIL", "scipy.stats", "pkg_resources"]
+
+# Runs in a new interpreter so nothing is cached in sys.modules.
+Probe = """
+import sys
+import time
+import json
+Start = time.perf_counter()
+import Bishop
+Elapsed = time.perf_counter() - Start
+print(json.dumps([Elapsed, [Module for Module in %s if Module in sys.modules]]))
+""" % repr(LazyModules)
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "-r", "--repeats", help="Number of fresh processes to time.", type=int, default=5)
+parser.add_argument(
+    "-l", "--limit", help="Largest median import time (in seconds) accepted.", type=float)
+args = parser.parse_args()
+
+Times = []
+Loaded = []
+for i in range(args.repeats):
+    Output = subprocess.check_output([sys.executable, "-c", Probe])
+    [Elapsed, Modules] = json.loads(Output.decode("utf-8").strip().splitlines()[-1])
+    Times.append(Elapsed)
+    Loaded = Modules
+Times.sort()
+Median = Times[len(Times) // 2]
+sys.stdout.write("import Bishop: median " + str(round(Median, 3)) + "s, min " + str(round(Times[0], 3)) +
+                 "s, max " + str(round(Times[-1], 3)) + "s over " + str(args.repeats) + " processes.\n")
+Failed = False
+if Loaded != []:
+    sys.stdout.write("ERROR: import Bishop loads " + ", ".join(Loaded) + ".\n")
+    Failed = True
+if args.limit is not None and Median > args.limit:
+    sys.stdout.write("ERROR: Import time is above the " + str(args.limit) + "s limit.\n")
+    Failed = True
+sys.exit(1 if Failed else 0)
@@ -19,6 +19,19 @@ or
 >> python BishopInference.py -m Tatik_T1_L1 -s 100 -a "2 2 2" -o "samples"
 
 saves output on "samples.p" as a pickle file.
+
+>> python BishopInference.py -m Tatik_T1_L1 -s 100 -a "2 2 2" -o "samples" --binary
+
+saves output on "samples.bpc" in binary format (load it with LoadSamples).
+
+To split an inference across machines, run each shard with the same seed and merge the outputs:
+
+>> python BishopInference.py -m Tatik_T1_L1 -s 1000 -a "2 2 2" --shard 0 --shards 2 --seed 7 -o "shard0"
+>> python BishopInference.py -m Tatik_T1_L1 -s 1000 -a "2 2 2" --shard 1 --shards 2 --seed 7 -o "shard1"
+>> python BishopInference.py --merge shard0.p shard1.p -o "samples"
+
+Shard i computes its share of the samples with seed + i and saves them unnormalized.
+The merged samples are renormalized together.
 """
 
 __author__ = "Julian Jara-Ettinger"
@@ -26,7 +39,9 @@ __license__ = "MIT"
 
 from Bishop import *
 import sys
+import random
 import argparse
+import numpy as np
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -41,9 +56,30 @@ parser.add_argument(
     "-sp", "--startingpoint", help="Agent's starting point.", type=int)
 parser.add_argument(
     "-v", "--verbose", help="Verbose?", action="store_true")
+parser.add_argument(
+    "-b", "--binary", help="Save samples in binary format instead of as a pickle file.", action="store_true")
+parser.add_argument(
+    "--shard", help="Index of the shard to run (from 0 to shards - 1).", type=int)
+parser.add_argument(
+    "--shards", help="Number of shards the inference is split into.", type=int, default=1)
+parser.add_argument(
+    "--seed", help="Random seed. Shard i uses seed + i.", type=int)
+parser.add_argument(
+    "--merge", help="Merge sample files saved by shards instead of running an inference.", nargs="+")
 
 args = parser.parse_args()
 
+if args.merge is not None:
+    Res = MergeContainers(args.merge)
+    if Res is None:
+        sys.exit("Could not merge samples.")
+    if args.output is not None:
+        SaveSamples(Res, args.output, args.binary)
+        Res.Summary(False, args.output)
+    else:
+        Res.Summary(False)
+    sys.exit()
+
 if args.map is None:
     sys.exit("Map file missing! Type Bishop -h for help.")
 
@@ -53,8 +89,19 @@ if args.actions is None:
 if args.samples is None:
     sys.exit("How many samples should I use? Type Bishop -h for help.")
 
+Shard = 0 if args.shard is None else args.shard
+if Shard < 0 or Shard >= args.shards:
+    sys.exit("Shard must be between 0 and shards - 1. Type Bishop -h for help.")
+if args.seed is not None:
+    random.seed(args.seed + Shard)
+    np.random.seed(args.seed + Shard)
+# This shard's share of the samples
+Samples = (Shard + 1) * args.samples // args.shards - Shard * args.samples // args.shards
+# Shards are saved unnormalized; MergeContainers normalizes them together.
+Normalize = args.shard is None
+
 # Don't print yet because we might change the starting point
-O = LoadObserver(args.map, False, True)
+O = LoadObserver(args.map, True)
 if args.startingpoint is not None:
     O.SetStartingPoint(args.startingpoint, False)
 # Need to split args.Actions
@@ -63,11 +110,11 @@ if ActionSequence[0].isdigit():
     ActionSequence = [int(s) for s in ActionSequence]
 if args.verbose:
     O.PrintMap()
-Res = O.InferAgent(ActionSequence, args.samples, args.verbose)
+Res = O.InferAgent(ActionSequence, Samples, args.verbose, Normalize)
 Res.AssociateMap(str(args.map))
 Res.MapFile = str(args.map)
 if args.output is not None:
-    SaveSamples(Res, args.output)
+    SaveSamples(Res, args.output, args.binary)
 if not args.verbose:
     if args.output is not None:
         Res.Summary(False, args.output)